@@ -0,0 +1,300 @@
+import os
+import sqlite3
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager
+from queue import Empty, LifoQueue
+from threading import Lock, RLock
+from time import monotonic, time
+
+from api import codec
+
+
+class LRUCache:
+    """
+    Thread-safe mapping bounded by the number of items
+    which evicts the least recently used item when it is full.
+    Items may also expire after `ttl` seconds.
+
+    With `maxweight` the items are also bounded by their total weight
+    told by `weigh`, e.g. the number of records they hold.
+
+    """
+
+    def __init__(self, maxsize, ttl=None, maxweight=None, weigh=len):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxweight = maxweight
+        self.weigh = weigh
+        self.weight = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = RLock()
+
+    def __len__(self):
+        return len(self._data)
+
+    @property
+    def stats(self):
+        return {'size': len(self), 'maxsize': self.maxsize,
+                'weight': self.weight,
+                'hits': self.hits, 'misses': self.misses}
+
+    def _pop(self, key=None):
+        """Remove the item or the least recently used one."""
+        if key is None:
+            _, (_, _, weight) = self._data.popitem(last=False)
+        else:
+            _, _, weight = self._data.pop(key)
+        self.weight -= weight
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires_at, _ = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if expires_at is not None and expires_at <= monotonic():
+                self._pop(key)
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl if ttl is not None else self.ttl
+        expires_at = monotonic() + ttl if ttl is not None else None
+        weight = self.weigh(value) if self.maxweight is not None else 0
+
+        with self._lock:
+            if key in self._data:
+                self._pop(key)
+            if self.maxweight is not None and weight > self.maxweight:
+                return
+
+            self._data[key] = (value, expires_at, weight)
+            self.weight += weight
+            while len(self._data) > self.maxsize or (
+                    self.maxweight is not None
+                    and self.weight > self.maxweight
+            ):
+                self._pop()
+
+    def get_or_create(self, key, factory):
+        """Return the cached value or store the one built by `factory`."""
+        with self._lock:
+            value = self.get(key)
+            if value is None:
+                value = factory()
+                self.set(key, value)
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.weight = 0
+            self.hits = 0
+            self.misses = 0
+
+
+class SQLitePool:
+    """
+    Small pool of SQLite connections shared by the threads of a worker.
+
+    Connections are opened lazily, so each forked worker gets its own
+    ones, and the `schema` statements run once with the first of them.
+    Up to `size` idle connections are kept open, the others are closed.
+
+    """
+
+    def __init__(self, path, schema=(), timeout=1, size=4):
+        self.path = path
+        self.schema = schema
+        self.timeout = timeout
+        self.size = size
+        self._idle = LifoQueue()
+        self._pid = None
+        self._lock = Lock()
+
+    def _connect(self):
+        connection = sqlite3.connect(
+            self.path, timeout=self.timeout, isolation_level=None,
+            check_same_thread=False
+        )
+        with self._lock:
+            if self._pid != os.getpid():
+                connection.execute('PRAGMA journal_mode=WAL')
+                for statement in self.schema:
+                    connection.execute(statement)
+                self._pid = os.getpid()
+        return connection
+
+    @contextmanager
+    def connection(self):
+        if self._pid != os.getpid():
+            # Connections of the parent process are never used after fork.
+            self._idle = LifoQueue()
+
+        try:
+            connection = self._idle.get_nowait()
+        except Empty:
+            connection = self._connect()
+
+        try:
+            yield connection
+        finally:
+            if self._idle.qsize() < self.size:
+                self._idle.put(connection)
+            else:
+                connection.close()
+
+
+def _key(key):
+    return codec.dumps(key).decode()
+
+
+class SQLiteCache:
+    """
+    Cache shared by all the workers of a container through a SQLite file.
+
+    Values are stored as JSON. Values larger than `max_value_size` bytes
+    are not stored, expired items and the items closest to expiration
+    beyond `maxsize` are evicted on writes.
+
+    """
+
+    def __init__(self, path, maxsize, ttl, max_value_size, timeout=1):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_value_size = max_value_size
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self._pool = SQLitePool(path, (
+            'CREATE TABLE IF NOT EXISTS cache ('
+            'key TEXT PRIMARY KEY, '
+            'value BLOB NOT NULL, '
+            'expires_at REAL NOT NULL)',
+            'CREATE INDEX IF NOT EXISTS cache_expires_at '
+            'ON cache (expires_at)'
+        ), timeout)
+
+    def __len__(self):
+        try:
+            with self._pool.connection() as connection:
+                return connection.execute(
+                    'SELECT COUNT(*) FROM cache WHERE expires_at > ?',
+                    (time(),)
+                ).fetchone()[0]
+        except sqlite3.Error:
+            return 0
+
+    @property
+    def stats(self):
+        return {'size': len(self), 'maxsize': self.maxsize,
+                'hits': self.hits, 'misses': self.misses}
+
+    def get(self, key, default=None):
+        try:
+            with self._pool.connection() as connection:
+                row = connection.execute(
+                    'SELECT value FROM cache WHERE key = ? AND expires_at > ?',
+                    (_key(key), time())
+                ).fetchone()
+        except sqlite3.Error:
+            row = None
+
+        if row is None:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        return codec.loads(row[0])
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl if ttl is not None else self.ttl
+        value = codec.dumps(value, sort_keys=False)
+        if len(value) > self.max_value_size:
+            return
+
+        now = time()
+        try:
+            with self._pool.connection() as connection:
+                connection.execute(
+                    'INSERT OR REPLACE INTO cache VALUES (?, ?, ?)',
+                    (_key(key), value, now + ttl)
+                )
+                connection.execute(
+                    'DELETE FROM cache WHERE expires_at <= ?', (now,)
+                )
+                connection.execute(
+                    'DELETE FROM cache WHERE key IN ('
+                    'SELECT key FROM cache ORDER BY expires_at LIMIT MAX(0, '
+                    '(SELECT COUNT(*) FROM cache) - ?))',
+                    (self.maxsize,)
+                )
+        except sqlite3.Error:
+            pass
+
+    def clear(self):
+        with self._pool.connection() as connection:
+            connection.execute('DELETE FROM cache')
+        self.hits = 0
+        self.misses = 0
+
+
+class SingleFlight:
+    """
+    Run a call once for all the concurrent callers with the same key.
+    The callers wait for it and share its result or its exception.
+
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._calls)
+
+    def do(self, key, function):
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self._calls[key] = Future()
+
+        if not is_leader:
+            return call.result()
+
+        try:
+            result = function()
+        except BaseException as error:
+            call.set_exception(error)
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+def create_cache(backend, maxsize, ttl, path=None, max_value_size=None,
+                 maxweight=None, weigh=len):
+    """
+    Return a cache of the backend type: `memory` or `sqlite`.
+    The memory one is also bounded by `maxweight`, the SQLite one
+    by the `max_value_size` bytes of an item.
+
+    """
+    if backend == 'sqlite':
+        return SQLiteCache(path, maxsize, ttl, max_value_size)
+
+    return LRUCache(maxsize, ttl, maxweight, weigh)
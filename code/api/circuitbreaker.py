@@ -0,0 +1,111 @@
+from collections import deque
+from contextlib import contextmanager
+from threading import Lock
+from time import monotonic
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker tracking the outcome of the last `window` calls.
+
+    A call fails if it raises one of the `failures` exceptions or takes
+    longer than `slow_call_duration` seconds. Once `min_calls` calls
+    were made and at least `failure_rate` of them failed, the circuit
+    opens and calls raise `CircuitOpenError` without being made.
+    After `open_duration` seconds the circuit is half open and lets
+    a single call through to probe the upstream: it closes the circuit
+    if it succeeds and opens it again otherwise.
+
+    """
+
+    def __init__(self, failures, window=20, min_calls=5, failure_rate=0.5,
+                 slow_call_duration=10, open_duration=30):
+        self.failures = failures
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_duration = slow_call_duration
+        self.open_duration = open_duration
+        self.state = CLOSED
+        self.opened_at = None
+        self._outcomes = deque(maxlen=window)
+        self._probing = False
+        self._lock = Lock()
+
+    @property
+    def stats(self):
+        with self._lock:
+            calls = len(self._outcomes)
+            failed = calls - sum(self._outcomes)
+            return {'state': self.state, 'calls': calls,
+                    'failure_rate': round(failed / calls, 2) if calls else 0}
+
+    def _before_call(self):
+        with self._lock:
+            if self.state == OPEN:
+                if monotonic() - self.opened_at < self.open_duration:
+                    raise CircuitOpenError
+                self.state = HALF_OPEN
+
+            if self.state == HALF_OPEN:
+                if self._probing:
+                    raise CircuitOpenError
+                self._probing = True
+
+    def _open(self):
+        self.state = OPEN
+        self.opened_at = monotonic()
+
+    def _record(self, succeeded):
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._probing = False
+                if succeeded:
+                    self.state = CLOSED
+                    self._outcomes.clear()
+                else:
+                    self._open()
+                return
+
+            self._outcomes.append(succeeded)
+            calls = len(self._outcomes)
+            failed = calls - sum(self._outcomes)
+            if (self.state == CLOSED and calls >= self.min_calls
+                    and failed >= calls * self.failure_rate):
+                self._open()
+
+    def _release(self):
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._probing = False
+
+    @contextmanager
+    def call(self):
+        """Guard the call made in the `with` block."""
+        self._before_call()
+        start = monotonic()
+        try:
+            yield
+        except self.failures:
+            self._record(False)
+            raise
+        except BaseException:
+            # The upstream answered, the call failed for another reason.
+            self._release()
+            raise
+        else:
+            self._record(monotonic() - start <= self.slow_call_duration)
+
+    def reset(self):
+        with self._lock:
+            self.state = CLOSED
+            self.opened_at = None
+            self._outcomes.clear()
+            self._probing = False
@@ -1,83 +1,585 @@
-import json
-from datetime import datetime, timedelta
+from datetime import timedelta
+from hashlib import sha256
 from http import HTTPStatus
+from itertools import count
+from random import uniform
+from time import monotonic, sleep, time
 
 import requests
-from requests.exceptions import SSLError, InvalidHeader
+from flask import current_app
+from requests.adapters import HTTPAdapter
+from requests.exceptions import (
+    SSLError, InvalidHeader, RequestException, Timeout, ConnectionError
+)
+from urllib3.exceptions import ReadTimeoutError
 
+from api import codec
+from api.cache import LRUCache, SingleFlight, create_cache
+from api.circuitbreaker import CircuitBreaker, CircuitOpenError
 from api.errors import (
     UnsupportedObservableTypeError,
     CriticalFarsightResponseError,
     FarsightSSLError,
-    AuthorizationError
+    FarsightLookupFailedError,
+    FarsightRateLimitError,
+    FarsightTimeoutError,
+    FarsightUnavailableError,
+    AuthorizationError,
+    TRFormattedError
 )
+from api.mappings import Mapping, Record, Records
+from api.ratelimit import create_rate_limiter
 from api.utils import join_url
 
 NOT_CRITICAL_ERRORS = (HTTPStatus.BAD_REQUEST, HTTPStatus.NOT_FOUND)
+CHUNK_SIZE = 64 * 1024
+
+_clients = None
+_lookups_cache = None
+_lookups_flight = SingleFlight()
+_rate_limiter = None
+_breaker = None
+
+
+def _bucket_for(rate):
+    """
+    Return the capacity and the refill rate of a token bucket
+    matching the quota DNSDB reports for an API key,
+    None for the defaults if the key has no burst quota.
+
+    https://api.dnsdb.info/#service-limits-and-quotas
+    """
+    remaining = rate.get('remaining')
+    if isinstance(remaining, int) and remaining <= 0:
+        return 0, 0
+
+    size, window = rate.get('burst_size'), rate.get('burst_window')
+    if (isinstance(size, int) and isinstance(window, int)
+            and size > 0 and window > 0):
+        return size, size / window
+
+    return None, None
+
+
+class _DeadlineExceeded(Exception):
+    """Timeout of a request cut short by the request deadline."""
+
+
+class RecordStream:
+    """
+    Iterator over the records of a lookup parsed while they are being
+    received, `limited` once it turns out they were truncated.
+    Closing it closes its `source`, a response or a first page,
+    even if it was never iterated.
+
+    """
+    limited = False
+
+    def __init__(self, parse, *args, source=None):
+        self._records = parse(*args, self)
+        self.source = source
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._records)
+
+    def close(self):
+        self._records.close()
+        close = getattr(self.source, 'close', None)
+        if close is not None:
+            close()
 
 
 class FarsightClient:
-    def __init__(self, base_url, api_key, user_agent):
+    def __init__(self, base_url, api_key, user_agent,
+                 pool_connections=1, pool_maxsize=10,
+                 cache=None, cache_max_records=None,
+                 time_filter_granularity=1,
+                 max_records=None, max_bytes=None,
+                 rate_limiter=None, quota_ttl=300,
+                 backoff_base=0.5, backoff_max=5, timeout=30,
+                 breaker=None, api_version=1):
         self.base_url = base_url
+        # API v2 frames the records with the Streaming API Framing (SAF).
+        self.saf = api_version == 2
+        self.api_url = (join_url(base_url, 'dnsdb', 'v2') if self.saf
+                        else base_url)
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.cache = cache
+        self.cache_max_records = cache_max_records
+        self.time_filter_granularity = time_filter_granularity
+        self.rate_limiter = rate_limiter
+        self.quota_ttl = quota_ttl
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.breaker = breaker
+        self.quota = (None, None)
+        self._quota_expires_at = 0
+        self.api_key_hash = sha256(api_key.encode()).hexdigest()
         self.headers = {
-            'Accept': 'application/json',
+            'Accept': ('application/x-ndjson' if self.saf
+                       else 'application/json'),
             'X-API-Key': api_key,
             'User-Agent': user_agent
         }
 
+        # Keep-alive connections to DNSDB are reused between lookups
+        # instead of paying for a new TCP and TLS handshake every time.
+        self.session = requests.Session()
+        self.session.mount(
+            base_url,
+            HTTPAdapter(pool_connections=pool_connections,
+                        pool_maxsize=pool_maxsize)
+        )
+
     @staticmethod
     def _path(type_):
-        path = {
-            'domain': 'rrset/name/',
-            'ip': 'rdata/ip/',
-            'ipv6': 'rdata/ip/',
-        }.get(type_)
+        mapping = Mapping.class_for(type_)
 
-        if not path:
+        if not mapping:
             raise UnsupportedObservableTypeError(type_)
 
-        return path
+        return mapping.PATH
 
-    @staticmethod
-    def _time_filter(days_delta):
-        start = datetime.now() - timedelta(days=days_delta)
-        return f'&time_last_after={int(start.timestamp())}'
+    def _time_last_after(self, days_delta):
+        """
+        Return the start of the time filter rounded down
+        to the granularity, so it does not change on every call.
+
+        """
+        start = int(time()) - int(timedelta(days=days_delta).total_seconds())
+        return start - start % self.time_filter_granularity
+
+    def _timeout(self, deadline):
+        """Return the timeout of a request which must end by `deadline`."""
+        if deadline is None:
+            return self.timeout
+
+        remaining = deadline - time()
+        if remaining <= 0:
+            raise FarsightTimeoutError
+        return min(self.timeout, remaining)
+
+    def _get(self, url, deadline=None, timeout=None, **kwargs):
+        try:
+            return self.session.get(
+                url, headers=self.headers,
+                timeout=timeout or self._timeout(deadline), **kwargs
+            )
+        except SSLError as error:
+            raise FarsightSSLError(error)
+        except Timeout:
+            raise FarsightTimeoutError
+        except (UnicodeEncodeError, InvalidHeader):
+            raise AuthorizationError
+
+    def _call(self, url, deadline=None, **kwargs):
+        """
+        Make a lookup request through the circuit breaker which counts
+        timeouts, connection errors and 5xx responses as failures.
+
+        Timeouts cut short by the request deadline are not counted,
+        as the deadline is set by the caller and not by DNSDB.
+
+        """
+        # A request past its deadline is not made nor counted.
+        timeout = self._timeout(deadline)
+        if self.breaker is None:
+            return self._get(url, timeout=timeout, **kwargs)
+
+        try:
+            with self.breaker.call():
+                try:
+                    response = self._get(url, timeout=timeout, **kwargs)
+                except FarsightTimeoutError:
+                    if timeout < self.timeout:
+                        raise _DeadlineExceeded
+                    raise
+
+                if (not response.ok and response.status_code
+                        >= HTTPStatus.INTERNAL_SERVER_ERROR):
+                    with response:
+                        raise CriticalFarsightResponseError(response)
+        except CircuitOpenError:
+            raise FarsightUnavailableError
+        except _DeadlineExceeded:
+            raise FarsightTimeoutError
+
+        return response
+
+    def rate_limit(self, deadline=None):
+        """Return the quota of the API key reported by DNSDB."""
+        path = ('rate_limit',) if self.saf else ('lookup', 'rate_limit')
+        with self._get(join_url(self.api_url, *path), deadline) as response:
+            if response.status_code == HTTPStatus.FORBIDDEN:
+                raise AuthorizationError
+
+            if not response.ok:
+                raise CriticalFarsightResponseError(response)
+
+            return response.json()['rate']
+
+    def _quota(self):
+        """
+        Return the capacity and the refill rate of the token bucket
+        of the API key, None for the defaults of the rate limiter.
+
+        """
+        if self._quota_expires_at <= monotonic():
+            return None, None
+        return self.quota
+
+    def _refresh_quota(self, deadline=None):
+        """Read the quota of the API key again once it has expired."""
+        if self._quota_expires_at > monotonic():
+            return
+
+        try:
+            self.quota = _bucket_for(self.rate_limit(deadline))
+        except (TRFormattedError, RequestException, KeyError, ValueError):
+            return
+        self._quota_expires_at = monotonic() + self.quota_ttl
+
+    def _backoff(self, attempt, response):
+        """
+        Return the seconds to wait before retrying a rate limited request:
+        an exponential backoff with full jitter, so the requests of
+        different workers do not retry in lockstep, or Retry-After.
+
+        """
+        delay = uniform(
+            0, min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        )
+        retry_after = response.headers.get('Retry-After', '')
+        if retry_after.isdigit():
+            delay = max(delay, int(retry_after))
+        return delay
 
     def _request_farsight(self, observable, action,
-                          number_of_days_to_filter=None, limit=None):
+                          time_last_after=None, limit=None,
+                          rrtype=None, aggr=False, retry_until=None,
+                          deadline=None, offset=None):
 
         path = self._path(observable['type'])
-        time_filter = self._time_filter(
-            number_of_days_to_filter) if number_of_days_to_filter else ''
-
         url = join_url(
-            self.base_url,
+            self.api_url,
             action,
             path,
             observable["value"],
-            '?humantime=True&aggr=False',
-            f'&limit={limit}' if limit else '',
-            time_filter
+            *([rrtype] if rrtype else [])
         )
-        try:
-            response = requests.get(url, headers=self.headers)
-        except SSLError as error:
-            raise FarsightSSLError(error)
-        except (UnicodeEncodeError, InvalidHeader):
-            raise AuthorizationError
 
-        if response.status_code == HTTPStatus.FORBIDDEN:
-            raise AuthorizationError
+        params = {'humantime': False, 'aggr': aggr}
+        if limit:
+            params['limit'] = limit
+        if time_last_after:
+            params['time_last_after'] = time_last_after
+        if offset:
+            params['offset'] = offset
+
+        # Requests wait for the rate limiter and are retried on 429
+        # until `retry_until`, so bursts slow down instead of failing.
+        retry_until = retry_until or time()
+        for attempt in count():
+            capacity, rate = self._quota()
+            if self.rate_limiter and not self.rate_limiter.acquire(
+                    self.api_key_hash, retry_until, capacity, rate
+            ):
+                if rate == 0:
+                    # DNSDB reported the quota of the key exhausted.
+                    raise FarsightRateLimitError
+                # No token came in time, DNSDB has refused nothing.
+                raise FarsightTimeoutError
+
+            response = self._call(
+                url, deadline, params=params, stream=True
+            )
+            if response.status_code != HTTPStatus.TOO_MANY_REQUESTS:
+                break
+
+            if self.rate_limiter:
+                self._refresh_quota(deadline)
+            delay = self._backoff(attempt, response)
+            if time() + delay > retry_until:
+                break
+
+            response.close()
+            sleep(delay)
 
         if response.ok:
-            return [json.loads(raw) for raw in response.iter_lines()]
+            return RecordStream(
+                self._records, response, deadline, source=response
+            )
+
+        with response:
+            if response.status_code == HTTPStatus.FORBIDDEN:
+                raise AuthorizationError
+
+            if response.status_code in NOT_CRITICAL_ERRORS:
+                return Records()
+
+            if (offset and response.status_code
+                    == HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE):
+                # DNSDB refuses offsets above the `offset_max` of the key,
+                # there may be more records than the pages can reach.
+                return Records(limited=True)
+
+            raise CriticalFarsightResponseError(response)
+
+    def _records(self, response, deadline, stream):
+        """
+        Parse NDJSON records while they are being received.
+
+        The connection is closed as soon as the consumer stops iterating,
+        the SAF stream ends or MAX_RECORDS records or MAX_BYTES bytes
+        have been read. The `stream` is marked `limited` if DNSDB
+        or these bounds truncated the records.
+        `FarsightTimeoutError` is raised if the records are still being
+        received at the `deadline`.
+
+        """
+        with response:
+            size = 0
+            number = 0
+            lines = response.iter_lines(chunk_size=CHUNK_SIZE)
+            try:
+                for raw in lines:
+                    size += len(raw)
+                    if self.max_bytes and size > self.max_bytes:
+                        stream.limited = True
+                        return
+
+                    if deadline is not None and time() > deadline:
+                        raise FarsightTimeoutError
+
+                    data = codec.loads(raw)
+                    if self.saf:
+                        # https://www.farsightsecurity.com/documentation/dnsdb/api/v2/#streaming-api-framing
+                        cond = data.get('cond')
+                        if cond == 'succeeded':
+                            return
+                        if cond == 'limited':
+                            stream.limited = True
+                            return
+                        if cond == 'failed':
+                            raise FarsightLookupFailedError(data.get('msg'))
+                        if 'obj' not in data:
+                            continue
+                        data = data['obj']
+
+                    yield Record.from_json(data)
+
+                    number += 1
+                    if self.max_records and number >= self.max_records:
+                        stream.limited = True
+                        return
+
+                # A SAF stream is incomplete without a terminating `cond`.
+                if self.saf:
+                    stream.limited = True
+            except ConnectionError as error:
+                # Requests reports read timeouts of a streamed body
+                # as connection errors.
+                if error.args and isinstance(error.args[0],
+                                             ReadTimeoutError):
+                    raise FarsightTimeoutError
+                raise
+
+    def _pages(self, page, observable, action, time_last_after, limit,
+               rrtype, aggr, retry_until, deadline, page_size, stream):
+        """
+        Yield the records of the first `page` and request the next ones
+        with DNSDB `offset` and `limit`, a page is requested only once
+        the previous one has been consumed. Up to `limit` records are
+        returned, the `stream` is marked `limited` if there may be more.
+
+        """
+        offset = 0
+        while True:
+            size = min(page_size, limit - offset) if limit else page_size
+            if offset:
+                page = self._request_farsight(
+                    observable, action, time_last_after, size, rrtype, aggr,
+                    retry_until, deadline, offset
+                )
+
+            number = 0
+            try:
+                for number, record in enumerate(page, start=1):
+                    yield record
+            finally:
+                if isinstance(page, RecordStream):
+                    page.close()
+
+            offset += number
+            if number < size:
+                # A short page is the last one unless it was cut short.
+                stream.limited = page.limited
+                return
 
-        if response.status_code in NOT_CRITICAL_ERRORS:
-            return []
+            if limit and offset >= limit:
+                stream.limited = True
+                return
 
-        raise CriticalFarsightResponseError(response)
+    def _lookup(self, observable, action, time_last_after, limit,
+                rrtype, aggr, retry_until, deadline, page_size):
+        if page_size:
+            limit = limit or self.max_records
+            # The first page is requested by the thread of the lookup,
+            # the next ones while the records are being consumed.
+            page = self._request_farsight(
+                observable, action, time_last_after,
+                min(page_size, limit) if limit else page_size,
+                rrtype, aggr, retry_until, deadline
+            )
+            return RecordStream(
+                self._pages, page, observable, action, time_last_after,
+                limit, rrtype, aggr, retry_until, deadline, page_size,
+                source=page
+            )
 
-    def lookup(self, observable, number_of_days_to_filter=None, limit=None):
         return self._request_farsight(
-            observable, 'lookup', number_of_days_to_filter, limit
+            observable, action, time_last_after, limit, rrtype, aggr,
+            retry_until, deadline
+        )
+
+    def _fetch(self, key, observable, action, time_last_after, limit,
+               rrtype, aggr, retry_until, deadline, page_size):
+        records = self._lookup(
+            observable, action, time_last_after, limit, rrtype, aggr,
+            retry_until, deadline, page_size
+        )
+        result = Records(records)
+        result.limited = records.limited
+        if self.cache is not None and (
+                self.cache_max_records is None
+                or len(result) <= self.cache_max_records):
+            self.cache.set(key, (result, result.limited))
+
+        return result
+
+    def lookup(self, observable, number_of_days_to_filter=None, limit=None,
+               stream=False, rrtype=None, aggr=False, retry_until=None,
+               deadline=None, page_size=None):
+        """
+        Return the records DNSDB has for the observable.
+
+        The records may be narrowed down to a single `rrtype`
+        and aggregated over time by DNSDB with `aggr`.
+
+        A rate limited lookup is retried until the `retry_until`
+        timestamp, by default it is not retried. A lookup which is
+        not done by the `deadline` timestamp raises `FarsightTimeoutError`.
+
+        With `page_size` the records are requested in pages of that size
+        up to `limit` records, one page at a time.
+
+        The records are `Records`, which are `limited` if they are
+        incomplete. With `stream` they are returned by a `RecordStream`
+        parsing the response while it is being received, they are
+        neither cached nor shared with concurrent lookups.
+
+        """
+        time_last_after = (self._time_last_after(number_of_days_to_filter)
+                           if number_of_days_to_filter else None)
+
+        if stream:
+            return self._lookup(
+                observable, 'lookup', time_last_after, limit, rrtype, aggr,
+                retry_until, deadline, page_size
+            )
+
+        key = (self.api_key_hash, observable['type'], observable['value'],
+               'lookup', limit, time_last_after, rrtype, aggr)
+
+        if self.cache is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                result, limited = cached
+                # Shared cache backends return records as plain lists.
+                if not isinstance(result, Records):
+                    result = Records(
+                        (Record.from_row(r) for r in result), limited
+                    )
+                return result
+
+        # Identical lookups running at the same time share one request.
+        return _lookups_flight.do(
+            key,
+            lambda: self._fetch(
+                key, observable, 'lookup', time_last_after, limit,
+                rrtype, aggr, retry_until, deadline, page_size
+            )
+        )
+
+
+def get_client(api_key):
+    """
+    Return a `FarsightClient` for the specified API key.
+
+    Clients live across requests of a worker so their connection pools
+    are reused, the least recently used ones are dropped.
+
+    """
+    global _clients, _lookups_cache, _rate_limiter, _breaker
+
+    config = current_app.config
+    if _clients is None:
+        _clients = LRUCache(config['FARSIGHT_CLIENTS_CACHE_SIZE'])
+    if _lookups_cache is None and config['FARSIGHT_CACHE_TTL']:
+        _lookups_cache = create_cache(
+            config['FARSIGHT_CACHE_BACKEND'],
+            config['FARSIGHT_CACHE_SIZE'],
+            config['FARSIGHT_CACHE_TTL'],
+            path=config['FARSIGHT_CACHE_PATH'],
+            max_value_size=config['FARSIGHT_CACHE_MAX_VALUE_SIZE'],
+            # Items are (records, limited) pairs.
+            maxweight=config['FARSIGHT_CACHE_MAX_TOTAL_RECORDS'],
+            weigh=lambda item: len(item[0])
+        )
+    if _rate_limiter is None:
+        _rate_limiter = create_rate_limiter(
+            config['FARSIGHT_RATE_LIMIT_BACKEND'],
+            config['FARSIGHT_RATE_LIMIT_CAPACITY'],
+            config['FARSIGHT_RATE_LIMIT_RATE'],
+            path=config['FARSIGHT_CACHE_PATH']
+        )
+    if _breaker is None and config['FARSIGHT_BREAKER_WINDOW']:
+        _breaker = CircuitBreaker(
+            (RequestException, FarsightTimeoutError,
+             CriticalFarsightResponseError),
+            window=config['FARSIGHT_BREAKER_WINDOW'],
+            min_calls=config['FARSIGHT_BREAKER_MIN_CALLS'],
+            failure_rate=config['FARSIGHT_BREAKER_FAILURE_RATE'],
+            slow_call_duration=config['FARSIGHT_BREAKER_SLOW_CALL_DURATION'],
+            open_duration=config['FARSIGHT_BREAKER_OPEN_DURATION']
+        )
+
+    return _clients.get_or_create(
+        api_key,
+        lambda: FarsightClient(
+            config['API_URL'],
+            api_key,
+            config['USER_AGENT'],
+            pool_connections=config['FARSIGHT_POOL_CONNECTIONS'],
+            pool_maxsize=config['FARSIGHT_POOL_MAXSIZE'],
+            cache=_lookups_cache,
+            cache_max_records=config['FARSIGHT_CACHE_MAX_RECORDS'],
+            time_filter_granularity=config[
+                'FARSIGHT_TIME_FILTER_GRANULARITY'
+            ],
+            max_records=config['FARSIGHT_MAX_RECORDS'],
+            max_bytes=config['FARSIGHT_MAX_BYTES'],
+            rate_limiter=_rate_limiter,
+            quota_ttl=config['FARSIGHT_RATE_LIMIT_QUOTA_TTL'],
+            backoff_base=config['FARSIGHT_BACKOFF_BASE'],
+            backoff_max=config['FARSIGHT_BACKOFF_MAX'],
+            timeout=config['FARSIGHT_TIMEOUT'],
+            breaker=_breaker,
+            api_version=config['FARSIGHT_API_VERSION']
         )
+    )
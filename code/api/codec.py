@@ -0,0 +1,47 @@
+"""
+JSON codec shared by the Farsight client and the relay responses.
+
+orjson is used when it is installed, the standard library otherwise.
+Encoding matches `flask.jsonify`, sorted keys, compact separators and
+ASCII-only output, byte for byte for documents without floats: orjson
+writes exponents and non-finite floats differently (`1e-7` for `1e-07`,
+`null` for `NaN`). The relay documents carry none.
+
+"""
+import json
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+def loads(data):
+    """Decode a JSON document, `bytes` are decoded without a copy to str."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _dumps(obj, sort_keys):
+    return json.dumps(
+        obj, sort_keys=sort_keys, separators=(',', ':'), ensure_ascii=True
+    ).encode()
+
+
+def dumps(obj, sort_keys=True):
+    """Encode an object to JSON `bytes`."""
+    if orjson is not None:
+        try:
+            result = orjson.dumps(
+                obj, option=orjson.OPT_SORT_KEYS if sort_keys else 0
+            )
+        except TypeError:
+            return _dumps(obj, sort_keys)
+
+        # orjson writes non-ASCII characters as UTF-8 where the standard
+        # library escapes them, such documents are encoded by the latter.
+        if result.isascii():
+            return result
+
+    return _dumps(obj, sort_keys)
@@ -1,11 +1,20 @@
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from contextlib import closing
 from functools import partial
+from itertools import chain
+from time import time
 
 from flask import Blueprint, current_app, g
 
-from api.client import FarsightClient
-from api.mappings import Mapping
+from api.client import get_client
+from api.errors import FarsightTimeoutError, LookupTimeoutWarning
+from api.mappings import Mapping, Records, current_time
 from api.schemas import ObservableSchema
-from api.utils import get_json, jsonify_data, get_key, jsonify_result
+from api.utils import (
+    get_json, jsonify_data, get_settings, jsonify_result,
+    jsonify_result_stream
+)
 
 enrich_api = Blueprint('enrich', __name__)
 
@@ -13,45 +22,170 @@ enrich_api = Blueprint('enrich', __name__)
 get_observables = partial(get_json, schema=ObservableSchema(many=True))
 
 
-@enrich_api.route('/observe/observables', methods=['POST'])
-def observe_observables():
-    key = get_key()
-    observables = get_observables()
+class Lookups:
+    """
+    Records of the lookups of an observable consumed one after another,
+    `limited` if any of them is.
 
-    client = FarsightClient(current_app.config['API_URL'],
-                            key,
-                            current_app.config['USER_AGENT'])
+    """
 
-    g.sightings = []
+    def __init__(self, lookups):
+        self.lookups = lookups
+
+    def __iter__(self):
+        return chain.from_iterable(self.lookups)
+
+    @property
+    def limited(self):
+        return any(lookup.limited for lookup in self.lookups)
+
+
+def enrich(observables, lookup, errors, settings, deadline):
+    """
+    Return a generator which looks the observables up concurrently
+    and yields the list of sightings of each observable in the order
+    of the observables as the request `settings` tell.
+    Errors of the Farsight data are added to `errors`.
+
+    Observables which are not looked up by the `deadline` timestamp
+    are skipped with a warning in `errors`.
+
+    The generator needs no application context, so it may be consumed
+    while the response is being streamed.
+
+    """
+    return _enrich(
+        observables, lookup, errors,
+        limit=settings.ctr_entities_limit,
+        aggr=settings.aggregate,
+        url_template=current_app.config['UI_SEARCH_URL'],
+        now=current_time(),
+        max_workers=current_app.config['FARSIGHT_MAX_CONCURRENT_LOOKUPS'],
+        deadline=deadline
+    )
+
+
+def _close_result(future):
+    """Close the records stream a finished lookup returned, if any."""
+    if not future.cancelled() and future.exception() is None:
+        close = getattr(future.result(), 'close', None)
+        if close is not None:
+            close()
 
-    limit = current_app.config['CTR_ENTITIES_LIMIT']
-    aggr = current_app.config['AGGREGATE']
-    time_delta = (current_app.config['NUMBER_OF_DAYS_FOR_FARSIGHT_TIME_FILTER']
-                  if aggr else None)
-    url_template = current_app.config['UI_SEARCH_URL']
 
+def _enrich(observables, lookup, errors,
+            limit, aggr, url_template, now, max_workers, deadline):
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    # Observables with the same canonical value are looked up once.
+    lookups = {}
     try:
+        queue = []
         for x in observables:
             mapping = Mapping.for_(x)
 
             if mapping:
-                lookup_data = client.lookup(x, time_delta)
-
-                if lookup_data:
-                    refer_link = url_template.format(query=x['value'])
-                    g.sightings.extend(
-                        mapping.extract_sightings(
-                            lookup_data, refer_link, limit, aggr
-                        )
-                    )
-
+                observable = mapping.normalized()
+                key = (observable['type'], observable['value'])
+                if key not in lookups:
+                    lookups[key] = [
+                        executor.submit(lookup, observable, rrtype)
+                        for rrtype in mapping.RRTYPES
+                    ]
+                queue.append((x, mapping, key))
+
+        # Results are gathered in the order of the observables,
+        # so the first failed lookup stops the output where it used to.
+        remaining = Counter(key for _, _, key in queue)
+        shared = {}
+        timed_out = set()
+        for x, mapping, key in queue:
+            remaining[key] -= 1
+            if key in timed_out:
+                errors.append(LookupTimeoutWarning(x).json)
+                continue
+
+            try:
+                if key in shared:
+                    lookup_data = (shared[key] if remaining[key]
+                                   else shared.pop(key))
+                else:
+                    lookup_data = Lookups([
+                        f.result(timeout=max(deadline - time(), 0))
+                        for f in lookups[key]
+                    ])
+                    if remaining[key]:
+                        records = shared[key] = Records(lookup_data)
+                        records.limited = lookup_data.limited
+                        lookup_data = records
+
+                refer_link = url_template.format(query=x['value'])
+                sightings = mapping.extract_sightings(
+                    lookup_data, refer_link, limit, aggr, now
+                )
+            except (TimeoutError, FarsightTimeoutError):
+                # The sightings found so far are still returned.
+                timed_out.add(key)
+                errors.append(LookupTimeoutWarning(x).json)
+                continue
+
+            yield sightings
     except KeyError:
-        g.errors = [{
+        errors.append({
             'type': 'fatal',
             'code': 'key error',
             'message': 'The data structure of Farsight DNSDB '
                        'has changed. The module is broken.'
-        }]
+        })
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        # Streams left unconsumed by an error or a timeout still hold
+        # their connections, including those of lookups still running.
+        for futures in lookups.values():
+            for f in futures:
+                f.add_done_callback(_close_result)
+
+
+@enrich_api.route('/observe/observables', methods=['POST'])
+def observe_observables():
+    settings = get_settings()
+    observables = get_observables()
+
+    client = get_client(settings.key)
+
+    aggr = settings.aggregate
+    time_delta = (current_app.config['NUMBER_OF_DAYS_FOR_FARSIGHT_TIME_FILTER']
+                  if aggr else None)
+    max_records = current_app.config['FARSIGHT_MAX_RECORDS']
+    page_size = current_app.config['FARSIGHT_PAGE_SIZE']
+    # Without a cache there is nothing to share the records with,
+    # so they are mapped while the response is being received.
+    stream = not current_app.config['FARSIGHT_CACHE_TTL']
+    # Every upstream call of the request shares one deadline.
+    deadline = time() + settings.request_deadline
+    retry_until = min(
+        deadline, time() + current_app.config['FARSIGHT_RETRY_BUDGET']
+    )
+
+    def lookup(observable, rrtype):
+        return client.lookup(
+            observable, time_delta, limit=max_records, stream=stream,
+            rrtype=rrtype, aggr=aggr, retry_until=retry_until,
+            deadline=deadline, page_size=page_size
+        )
+
+    errors = []
+    sightings = enrich(observables, lookup, errors, settings, deadline)
+
+    if current_app.config['STREAM_OBSERVE_RESPONSE']:
+        return jsonify_result_stream(sightings, errors)
+
+    g.sightings = []
+    with closing(sightings):
+        for chunk in sightings:
+            g.sightings.extend(chunk)
+
+    if errors:
+        g.errors = errors
 
     return jsonify_result()
 
@@ -61,12 +195,12 @@ def refer_observables():
     observables = get_observables()
 
     url_template = current_app.config['UI_SEARCH_URL']
-    observable_types_map = current_app.config['FARSIGHT_OBSERVABLES']
 
     data = []
     for observable in observables:
-        type_ = observable_types_map.get(observable['type'])
-        if type_:
+        mapping = Mapping.class_for(observable['type'])
+        if mapping:
+            type_ = mapping.TITLE
             data.append(
                 {
                     'id': (
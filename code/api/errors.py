@@ -7,6 +7,7 @@ TOO_MANY_REQUESTS = 'too many requests'
 UNAUTHORIZED = 'unauthorized'
 NOT_FOUND = 'not found'
 UNAVAILABLE = 'unavailable'
+TIMEOUT = 'timeout'
 AUTH_ERROR = 'authorization error'
 BAD_API_KEY = 'Error: Bad API key'
 
@@ -80,6 +81,49 @@ class CriticalFarsightResponseError(TRFormattedError):
         )
 
 
+class FarsightRateLimitError(TRFormattedError):
+    def __init__(self):
+        super().__init__(
+            TOO_MANY_REQUESTS,
+            'The rate limit of Farsight DNSDB has been reached, '
+            'try again later.'
+        )
+
+
+class FarsightLookupFailedError(TRFormattedError):
+    def __init__(self, message):
+        super().__init__(
+            UNKNOWN,
+            f'Farsight DNSDB failed to complete the lookup: {message}'
+        )
+
+
+class FarsightUnavailableError(TRFormattedError):
+    def __init__(self):
+        super().__init__(
+            UNAVAILABLE,
+            'Farsight DNSDB is unavailable, try again later.'
+        )
+
+
+class FarsightTimeoutError(TRFormattedError):
+    def __init__(self):
+        super().__init__(
+            TIMEOUT,
+            'Farsight DNSDB did not respond in time.'
+        )
+
+
+class LookupTimeoutWarning(TRFormattedError):
+    def __init__(self, observable):
+        super().__init__(
+            TIMEOUT,
+            f'The lookup of {observable["value"]} in Farsight DNSDB '
+            'did not finish in time, its sightings are missing.',
+            type_='warning'
+        )
+
+
 class WatchdogError(TRFormattedError):
     def __init__(self):
         super().__init__(
@@ -1,22 +1,52 @@
+from time import monotonic
+
 from flask import Blueprint, current_app
 
-from api.client import FarsightClient
+from api.cache import LRUCache
+from api.client import get_client
 from api.utils import jsonify_data, get_key
 
 health_api = Blueprint('health', __name__)
 
+# Health is polled often, so the result of a probe is reused per API key.
+_health_cache = LRUCache(maxsize=1024)
+
+
+def _probe(client):
+    """
+    Check DNSDB with the rate_limit endpoint which neither runs a lookup
+    nor uses the quota, and report the quota and the upstream latency.
+
+    """
+    start = monotonic()
+    quota = client.rate_limit()
+    return {
+        'status': 'ok',
+        'quota': quota,
+        'latency_ms': round((monotonic() - start) * 1000)
+    }
+
 
 @health_api.route('/health', methods=['POST'])
 def health():
     key = get_key()
 
-    client = FarsightClient(current_app.config['API_URL'],
-                            key,
-                            current_app.config['USER_AGENT'])
+    client = get_client(key)
+
+    if current_app.config['HEALTH_CHECK'] == 'lookup':
+        _ = list(client.lookup(
+            {'value': 'www.farsightsecurity.com', 'type': 'domain'},
+            limit=1, stream=True
+        ))
+        return jsonify_data({'status': 'ok'})
+
+    data = _health_cache.get(client.api_key_hash)
+    if data is None:
+        data = _probe(client)
+        _health_cache.set(client.api_key_hash, data,
+                          ttl=current_app.config['HEALTH_CACHE_TTL'])
 
-    _ = client.lookup(
-        {'value': 'www.farsightsecurity.com', 'type': 'domain'},
-        limit=1
-    )
+    if client.breaker is not None:
+        data = {**data, 'circuit_breaker': client.breaker.stats}
 
-    return jsonify_data({'status': 'ok'})
+    return jsonify_data(data)
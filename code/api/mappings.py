@@ -1,9 +1,14 @@
 from abc import ABCMeta, abstractmethod
-from datetime import datetime
+from datetime import datetime, timezone
+from heapq import nlargest
+from ipaddress import ip_address
+from itertools import count
+from operator import attrgetter
+from sys import intern
+from time import gmtime, strftime
+from typing import NamedTuple, Optional, Tuple
 from uuid import uuid4
 
-from api.utils import all_subclasses
-
 CTIM_DEFAULTS = {
     'schema_version': '1.0.17',
 }
@@ -11,26 +16,154 @@ CTIM_DEFAULTS = {
 RESOLVED_TO = 'Resolved_To'
 
 
+def timestamp(humantime):
+    """Convert Farsight `2013-01-18T05:38:08Z` time to a UNIX timestamp."""
+    return int(
+        datetime.fromisoformat(humantime.rstrip('Z'))
+        .replace(tzinfo=timezone.utc)
+        .timestamp()
+    )
+
+
+def humantime(timestamp_):
+    """Convert a UNIX timestamp to Farsight `2013-01-18T05:38:08Z` time."""
+    return strftime('%Y-%m-%dT%H:%M:%SZ', gmtime(timestamp_))
+
+
+def current_time():
+    """Return the time of the investigation as a sighting time."""
+    return f'{datetime.now().isoformat(timespec="seconds")}Z'
+
+
+def transient_ids(entity_type):
+    """
+    Generate unique transient IDs of entities,
+    a random UUID is made once instead of once per ID.
+
+    """
+    prefix = f'transient:{entity_type}-{uuid4().hex[:24]}'
+    return (f'{prefix}{number:08x}' for number in count())
+
+
+def _timestamp(value):
+    if value is None or isinstance(value, int):
+        return value
+    return timestamp(value)
+
+
+class Record(NamedTuple):
+    """
+    Farsight DNSDB record reduced to the fields the mappings use.
+
+    Timestamps are kept as integers and repeated strings are interned.
+    Being a tuple, a record takes little memory and survives
+    a round trip through JSON as a list.
+
+    """
+    count: int
+    time_first: Optional[int] = None
+    time_last: Optional[int] = None
+    zone_time_first: Optional[int] = None
+    zone_time_last: Optional[int] = None
+    rrname: Optional[str] = None
+    rrtype: Optional[str] = None
+    bailiwick: Optional[str] = None
+    rdata: Tuple[str, ...] = ()
+
+    @classmethod
+    def from_json(cls, data):
+        rdata = data['rdata']
+        if isinstance(rdata, str):
+            rdata = (rdata,)
+
+        bailiwick = data.get('bailiwick')
+
+        return cls(
+            data['count'],
+            _timestamp(data.get('time_first')),
+            _timestamp(data.get('time_last')),
+            _timestamp(data.get('zone_time_first')),
+            _timestamp(data.get('zone_time_last')),
+            intern(data['rrname']),
+            intern(data['rrtype']),
+            intern(bailiwick) if bailiwick else None,
+            tuple(intern(r) for r in rdata)
+        )
+
+    @classmethod
+    def from_row(cls, row):
+        """Restore a record which went through JSON as a list."""
+        *fields, rdata = row
+        return cls(*fields, tuple(rdata))
+
+    @property
+    def last_seen(self):
+        # Search result may be missing either time_ or zone_time_ pair
+        # but at least one pair of timestamps will always be present.
+        if self.time_last is not None:
+            return self.time_last
+        return self.zone_time_last
+
+
+class Records(list):
+    """Records of a lookup, `limited` if they are incomplete."""
+
+    def __init__(self, records=(), limited=False):
+        super().__init__(records)
+        self.limited = limited
+
+
 class Mapping(metaclass=ABCMeta):
+    # Human readable name of the observable type.
+    TITLE = None
+    # DNSDB lookup path for the observable type.
+    PATH = None
+    # DNSDB lookups to run for an observable, None stands for any rrtype.
+    RRTYPES = (None,)
+
+    _registry = {}
 
     def __init__(self, observable):
         self.observable = observable
 
+    def __init_subclass__(cls, **kwargs):
+        """Register the mapping for the observable type it processes."""
+        super().__init_subclass__(**kwargs)
+
+        type_ = cls.type()
+        if type_:
+            Mapping._registry[type_] = cls
+
     @classmethod
     def for_(cls, observable):
         """Return an instance of `Mapping` for the specified type."""
+        subcls = cls.class_for(observable['type'])
+        return subcls(observable) if subcls else None
 
-        for subcls in all_subclasses(Mapping):
-            if subcls.type() == observable['type']:
-                return subcls(observable)
+    @classmethod
+    def class_for(cls, type_):
+        """Return the `Mapping` subclass for the specified type if any."""
+        return Mapping._registry.get(type_)
+
+    @staticmethod
+    def normalize(value):
+        """Return the canonical form of an observable value."""
+        return value
 
-        return None
+    def normalized(self):
+        """Return the observable with its value in the canonical form."""
+        return {'type': self.observable['type'],
+                'value': self.normalize(self.observable['value'])}
 
     @classmethod
     @abstractmethod
     def type(cls):
         """Return the observable type that the mapping is able to process."""
 
+    def _filter(self, records):
+        """Return the records the sightings are made of."""
+        return records
+
     @staticmethod
     @abstractmethod
     def _extract_related(record):
@@ -52,43 +185,47 @@ class Mapping(metaclass=ABCMeta):
     def _description(self, aggr=True):
         """Return description field depending on observable type."""
 
-    def _sighting(self, record, refer_link, description):
-        def observed_time():
-            start_time = (
-                record.get('time_first')
-                or record.get('zone_time_first')
-                or f'{datetime.now().isoformat(timespec="seconds")}Z'
-            )
-
-            end_time = (
-                record.get('time_last')
-                or record.get('zone_time_last')
-                or start_time
-            )
-
-            return {'start_time': start_time, 'end_time': end_time}
-
-        def data_source():
-            if record.get('time_first'):
-                return 'Passive DNS replication'
-            elif record.get('zone_time_first'):
-                return 'Zone file import'
-
-        result = {
+    def _sighting_template(self, refer_link, description):
+        """Return the fields all the sightings of the observable share."""
+        return {
             **CTIM_DEFAULTS,
-            'id': f'transient:sighting-{uuid4()}',
             'type': 'sighting',
             'source': 'Farsight DNSDB',
             'title': 'Found in Farsight DNSDB',
             'confidence': 'High',
             'internal': False,
-            'count': record['count'],
             'observables': [self.observable],
-            'observed_time': observed_time(),
             'description': description,
             'source_uri': refer_link
         }
 
+    def _sighting(self, record, template, id_, now):
+        def observed_time():
+            if record.time_first is not None:
+                start, end = record.time_first, record.time_last
+            elif record.zone_time_first is not None:
+                start, end = record.zone_time_first, record.zone_time_last
+            else:
+                return {'start_time': now, 'end_time': now}
+
+            return {
+                'start_time': humantime(start),
+                'end_time': humantime(end if end is not None else start)
+            }
+
+        def data_source():
+            if record.time_first is not None:
+                return 'Passive DNS replication'
+            elif record.zone_time_first is not None:
+                return 'Zone file import'
+
+        result = {
+            **template,
+            'id': id_,
+            'count': record.count,
+            'observed_time': observed_time(),
+        }
+
         sensor = data_source()
         if sensor:
             result['sensor'] = sensor
@@ -96,48 +233,79 @@ class Mapping(metaclass=ABCMeta):
         return result
 
     def extract_sightings(
-            self, lookup_data, refer_link, limit, aggregate=True
+            self, lookup_data, refer_link, limit, aggregate=True, now=None
     ):
-        # Search result may be missing either time_ or zone_time_ pair
-        # but at least one pair of timestamps will always be present.
+        """
+        Map `Record`s Farsight has for the observable to sightings.
+        `now` is the observation time of records without timestamps,
+        the time of the call by default.
+
+        The description tells when `lookup_data` turns out `limited`
+        once it has been consumed.
+
+        """
+        records = self._filter(lookup_data)
+        description = self._description(aggregate)
         if aggregate:
-            lookup_data = self.aggregate_data(lookup_data)
+            count, related, total = self.aggregate_data(records, limit)
+            limited = getattr(lookup_data, 'limited', False)
+            if total > len(related):
+                description += (f' ({len(related)} most recently seen of'
+                                f' {"at least " if limited else ""}{total})')
+            elif limited:
+                description += ' (results truncated)'
+            lookup_data = [(Record(count), related)]
         else:
-            lookup_data.sort(
-                key=lambda r: r.get('time_last') or r.get('zone_time_last'),
-                reverse=True
+            # Only the `limit` most recent records are kept in a heap
+            # while the records are consumed, which gives the same result
+            # as sorting all of them but in O(n log limit).
+            records = nlargest(limit, records, key=attrgetter('last_seen'))
+            if getattr(lookup_data, 'limited', False):
+                description += ' (results truncated)'
+            lookup_data = (
+                (record, sorted(set(self._extract_related(record))))
+                for record in records
             )
-            lookup_data = lookup_data[:limit]
-
-        result = []
-        description = self._description(aggregate)
-        for record in lookup_data:
 
-            related = (record['related'] if aggregate
-                       else self._extract_related(record))
+        now = now or current_time()
+        ids = transient_ids('sighting')
+        template = self._sighting_template(refer_link, description)
 
+        result = []
+        for record, related in lookup_data:
             if related:
-                related = sorted(set(related))
-                sighting = self._sighting(record, refer_link, description)
+                sighting = self._sighting(record, template, next(ids), now)
                 sighting['relations'] = [self._resolved_to(r) for r in related]
 
                 result.append(sighting)
 
         return result
 
-    def aggregate_data(self, lookup_data):
-        """Restructure Farsight response for single sighting mode."""
+    def aggregate_data(self, lookup_data, limit):
+        """
+        Restructure Farsight response for single sighting mode.
+
+        Return the total count, the sorted `limit` most recently seen
+        related values and the number of distinct related values.
+
+        """
         count = 0
-        related = []
+        last_seen = {}
 
         for record in lookup_data:
-            count += record['count']
-            related.extend(self._extract_related(record))
+            count += record.count
+            seen = record.last_seen or 0
+            for value in self._extract_related(record):
+                if last_seen.get(value, -1) < seen:
+                    last_seen[value] = seen
+
+        related = last_seen.keys()
+        if len(last_seen) > limit:
+            related = nlargest(
+                limit, related, key=lambda value: (last_seen[value], value)
+            )
 
-        return [{
-            'count': count,
-            'related': sorted(related)
-        }]
+        return count, sorted(related), len(last_seen)
 
     @staticmethod
     def observable_relation(relation_type, source, related):
@@ -150,17 +318,24 @@ class Mapping(metaclass=ABCMeta):
 
 
 class Domain(Mapping):
+    TITLE = 'domain'
+    PATH = 'rrset/name/'
+
     @classmethod
     def type(cls):
         return 'domain'
 
     RRTYPES = ('A', 'AAAA')
 
+    @staticmethod
+    def normalize(value):
+        return value.rstrip('.').lower()
+
     def _description(self, aggr=True):
         return f'IP addresses that {self.observable["value"]} resolves to'
 
     def _extract_related(self, record):
-        return record['rdata']
+        return record.rdata
 
     def _resolved_to(self, ip):
         return self.observable_relation(
@@ -172,39 +347,44 @@ class Domain(Mapping):
             }
         )
 
-    def _sighting(self, record, refer_link, description):
-        result = super()._sighting(record, refer_link, description)
+    def _sighting(self, record, template, id_, now):
+        result = super()._sighting(record, template, id_, now)
 
-        if record.get("bailiwick"):
+        if record.bailiwick:
             # SightingDataTable Object:
             # https://github.com/threatgrid/ctim/blob/master/doc/structures/sighting.md#map3
             result['data'] = {
                 'columns': [{'name': 'Bailiwick', 'type': 'string'}],
-                'rows': [[record["bailiwick"]]]
+                'rows': [[record.bailiwick]]
             }
 
         return result
 
-    def extract_sightings(
-            self, lookup_data, refer_link, limit, aggregate=True
-    ):
-        lookup_data = [r for r in lookup_data if r['rrtype'] in self.RRTYPES]
-        return super().extract_sightings(
-            lookup_data, refer_link, limit, aggregate
-        )
+    def _filter(self, records):
+        return (r for r in records if r.rrtype in self.RRTYPES)
 
 
 class IP(Mapping):
+    TITLE = 'IP'
+    PATH = 'rdata/ip/'
+
     @classmethod
     def type(cls):
         return 'ip'
 
+    @staticmethod
+    def normalize(value):
+        try:
+            return str(ip_address(value))
+        except ValueError:
+            return value
+
     def _description(self, aggr=True):
         return (f'{"Hostnames that have" if aggr else "Hostname that has"}'
                 f' resolved to {self.observable["value"]}')
 
     def _extract_related(self, record):
-        return [record['rrname']]
+        return [record.rrname]
 
     def _resolved_to(self, domain):
         # Remove trailing dot for compatibility with TR
@@ -217,6 +397,8 @@ class IP(Mapping):
 
 
 class IPV6(IP):
+    TITLE = 'IPv6'
+
     @classmethod
     def type(cls):
         return 'ipv6'
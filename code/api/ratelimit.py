@@ -0,0 +1,132 @@
+import sqlite3
+from threading import Lock
+from time import sleep, time
+
+from api.cache import SQLitePool
+
+
+def _take(tokens, updated_at, now, capacity, rate):
+    """
+    Refill a token bucket and take a token out of it.
+    Return the tokens left and the seconds to wait for a token
+    if there is none.
+
+    """
+    tokens = min(capacity, tokens + (now - updated_at) * rate)
+    if tokens >= 1:
+        return tokens - 1, 0
+    return tokens, (1 - tokens) / rate if rate else None
+
+
+class TokenBuckets:
+    """Token buckets kept in the memory of a worker."""
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = Lock()
+
+    def take(self, key, capacity, rate):
+        now = time()
+        with self._lock:
+            tokens, updated_at = self._buckets.get(key, (capacity, now))
+            tokens, wait = _take(tokens, updated_at, now, capacity, rate)
+            self._buckets[key] = (tokens, now)
+        return wait
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class SQLiteTokenBuckets:
+    """Token buckets shared by all the workers through a SQLite file."""
+
+    def __init__(self, path, timeout=1):
+        self.path = path
+        self.timeout = timeout
+        self._pool = SQLitePool(path, (
+            'CREATE TABLE IF NOT EXISTS token_buckets ('
+            'key TEXT PRIMARY KEY, '
+            'tokens REAL NOT NULL, '
+            'updated_at REAL NOT NULL)',
+        ), timeout)
+
+    def take(self, key, capacity, rate):
+        with self._pool.connection() as connection:
+            return self._take(connection, key, capacity, rate)
+
+    @staticmethod
+    def _take(connection, key, capacity, rate):
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            now = time()
+            row = connection.execute(
+                'SELECT tokens, updated_at FROM token_buckets WHERE key = ?',
+                (key,)
+            ).fetchone()
+            tokens, updated_at = row or (capacity, now)
+            tokens, wait = _take(tokens, updated_at, now, capacity, rate)
+            connection.execute(
+                'INSERT OR REPLACE INTO token_buckets VALUES (?, ?, ?)',
+                (key, tokens, now)
+            )
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        else:
+            connection.execute('COMMIT')
+        return wait
+
+    def clear(self):
+        with self._pool.connection() as connection:
+            connection.execute('DELETE FROM token_buckets')
+
+
+class RateLimiter:
+    """
+    Token bucket rate limiter holding `capacity` tokens per key
+    which are refilled at `rate` tokens per second.
+    Keys are not limited without a capacity.
+
+    """
+
+    def __init__(self, buckets, capacity=None, rate=None):
+        self.buckets = buckets
+        self.capacity = capacity
+        self.rate = rate
+
+    def acquire(self, key, until, capacity=None, rate=None):
+        """
+        Wait for a token until the `until` timestamp.
+        Return whether the token was acquired.
+
+        """
+        capacity = capacity if capacity is not None else self.capacity
+        rate = rate if rate is not None else self.rate
+        if capacity is None:
+            return True
+
+        while True:
+            try:
+                wait = self.buckets.take(key, capacity, rate)
+            except sqlite3.Error:
+                # The limiter must never be the reason a lookup fails.
+                return True
+
+            if wait == 0:
+                return True
+            if wait is None or time() + wait > until:
+                return False
+
+            sleep(wait)
+
+    def clear(self):
+        self.buckets.clear()
+
+
+def create_rate_limiter(backend, capacity=None, rate=None, path=None):
+    """Return a rate limiter of the backend type: `memory` or `sqlite`."""
+    if backend == 'sqlite':
+        return RateLimiter(SQLiteTokenBuckets(path), capacity, rate)
+
+    return RateLimiter(TokenBuckets(), capacity, rate)
@@ -1,14 +1,27 @@
 import json
+import traceback
+from collections import namedtuple
+from contextlib import closing
+from hashlib import sha256
 from json import JSONDecodeError
-from typing import Union
+from threading import Lock
+from time import monotonic, time
+from typing import NamedTuple, Union
 
 import jwt
 import requests
-from flask import request, current_app, jsonify, g
+import flask
+from flask import request, current_app, g
 from jwt import InvalidSignatureError, InvalidAudienceError, DecodeError
-from requests.exceptions import ConnectionError, InvalidURL, HTTPError
+from requests.exceptions import (
+    ConnectionError, InvalidURL, HTTPError, Timeout
+)
 
-from api.errors import InvalidArgumentError, AuthorizationError
+from api import codec
+from api.cache import LRUCache
+from api.errors import (
+    InvalidArgumentError, AuthorizationError, TRFormattedError, UNKNOWN
+)
 
 NO_AUTH_HEADER = 'Authorization header is missing'
 WRONG_AUTH_TYPE = 'Wrong authorization type'
@@ -24,47 +37,119 @@ JWKS_HOST_MISSING = ('jwks_host is missing in JWT payload. Make sure '
 WRONG_JWKS_HOST = ('Wrong jwks_host in JWT payload. Make sure domain follows '
                    'the visibility.<region>.cisco.com structure')
 
+JWKS = namedtuple('JWKS', ('keys', 'fetched_at'))
 
-def set_ctr_entities_limit(payload):
+_jwks_cache = LRUCache(maxsize=16)
+# Keys of a jwks_host are refreshed by one thread at a time,
+# a slow host does not hold up the others.
+_jwks_locks = LRUCache(maxsize=16)
+
+_tokens_cache = LRUCache(maxsize=1024)
+
+
+class Settings(NamedTuple):
+    """
+    Settings of a request taken from its JWT. They are passed along
+    explicitly so concurrent requests of different tenants never
+    share them through the application config.
+
+    """
+    key: str
+    ctr_entities_limit: int
+    aggregate: bool
+    request_deadline: float
+
+    @classmethod
+    def from_payload(cls, payload):
+        return cls(
+            payload['key'],
+            _ctr_entities_limit(payload),
+            _aggregate(payload),
+            _request_deadline(payload)
+        )
+
+
+def _ctr_entities_limit(payload):
     try:
         ctr_entities_limit = int(payload['CTR_ENTITIES_LIMIT'])
         assert ctr_entities_limit > 0
     except (KeyError, ValueError, AssertionError):
         ctr_entities_limit = current_app.config['CTR_ENTITIES_LIMIT_DEFAULT']
-    current_app.config['CTR_ENTITIES_LIMIT'] = ctr_entities_limit \
+    return ctr_entities_limit \
         if ctr_entities_limit < current_app.config['CTR_ENTITIES_LIMIT_MAX'] \
         else current_app.config['CTR_ENTITIES_LIMIT_MAX']
 
 
-def set_aggregate(payload):
+def _aggregate(payload):
     try:
-        aggregate = str(payload['AGGREGATE']).lower() != 'false'
+        return str(payload['AGGREGATE']).lower() != 'false'
     except (KeyError, ValueError):
-        aggregate = current_app.config['AGGREGATE_DEFAULT']
-    current_app.config['AGGREGATE'] = aggregate
+        return current_app.config['AGGREGATE_DEFAULT']
+
+
+def _request_deadline(payload):
+    try:
+        request_deadline = float(payload['REQUEST_DEADLINE'])
+        assert request_deadline > 0
+    except (KeyError, ValueError, TypeError, AssertionError):
+        request_deadline = current_app.config['REQUEST_DEADLINE_DEFAULT']
+    return min(request_deadline, current_app.config['REQUEST_DEADLINE_MAX'])
+
+
+def _fetch_public_keys(jwks_host):
+    response = requests.get(
+        f"https://{jwks_host}/.well-known/jwks",
+        timeout=current_app.config['JWKS_TIMEOUT']
+    )
+    response.raise_for_status()
+    jwks = response.json()
+
+    public_keys = {}
+    for jwk in jwks['keys']:
+        kid = jwk['kid']
+        public_keys[kid] = jwt.algorithms.RSAAlgorithm.from_jwk(
+            json.dumps(jwk)
+        )
+    return public_keys
 
 
 def get_public_key(jwks_host, token):
+    """
+    Return the public key the token was signed with.
+
+    Parsed keys are cached per jwks_host for JWKS_CACHE_TTL seconds,
+    the keys are fetched again if the token refers to an unknown kid.
+
+    """
     expected_errors = (
         ConnectionError,
         InvalidURL,
         JSONDecodeError,
         HTTPError,
+        Timeout,
     )
 
+    def is_stale(jwks):
+        return jwks is None or (
+            kid not in jwks.keys
+            and monotonic() - jwks.fetched_at
+            >= current_app.config['JWKS_CACHE_MIN_REFRESH_INTERVAL']
+        )
+
     try:
-        response = requests.get(f"https://{jwks_host}/.well-known/jwks")
-        response.raise_for_status()
-        jwks = response.json()
-
-        public_keys = {}
-        for jwk in jwks['keys']:
-            kid = jwk['kid']
-            public_keys[kid] = jwt.algorithms.RSAAlgorithm.from_jwk(
-                json.dumps(jwk)
-            )
         kid = jwt.get_unverified_header(token)['kid']
-        return public_keys.get(kid)
+
+        cached = _jwks_cache.get(jwks_host)
+        if is_stale(cached):
+            with _jwks_locks.get_or_create(jwks_host, Lock):
+                # Another thread may have refreshed the keys meanwhile.
+                cached = _jwks_cache.get(jwks_host)
+                if is_stale(cached):
+                    cached = JWKS(_fetch_public_keys(jwks_host), monotonic())
+                    _jwks_cache.set(jwks_host, cached,
+                                    current_app.config['JWKS_CACHE_TTL'])
+
+        return cached.keys.get(kid)
     except expected_errors:
         raise AuthorizationError(WRONG_JWKS_HOST)
 
@@ -85,10 +170,45 @@ def get_auth_token() -> Union[str, Exception]:
         raise AuthorizationError(expected_errors[error.__class__])
 
 
-def get_key() -> Union[str, Exception]:
+def _verify_token(token, aud):
+    jwks_payload = jwt.decode(token, options={'verify_signature': False})
+    assert 'jwks_host' in jwks_payload
+    jwks_host = jwks_payload.get('jwks_host')
+    key = get_public_key(jwks_host, token)
+    return jwt.decode(
+        token, key=key, algorithms=['RS256'], audience=[aud]
+    )
+
+
+def get_verified_payload(token, aud):
+    """
+    Return the payload of the token verified against the audience.
+
+    Verified payloads are cached by the token digest and the audience
+    until the token expires, but no longer than TOKEN_CACHE_TTL seconds.
+
+    """
+    cache_key = (sha256(token.encode()).hexdigest(), aud)
+    payload = _tokens_cache.get(cache_key)
+
+    if payload is None:
+        payload = _verify_token(token, aud)
+
+        ttl = current_app.config['TOKEN_CACHE_TTL']
+        if 'exp' in payload:
+            ttl = min(ttl, payload['exp'] - time())
+
+        if ttl > 0:
+            _tokens_cache.set(cache_key, payload, ttl)
+
+    return payload
+
+
+def get_settings() -> Union[Settings, Exception]:
     """
     Get authorization token and validate its signature against the public key
-    from /.well-known/jwks endpoint. Extract and validate credentials.
+    from /.well-known/jwks endpoint. Extract and validate credentials
+    and the settings of the request.
     """
 
     expected_errors = {
@@ -102,23 +222,20 @@ def get_key() -> Union[str, Exception]:
 
     token = get_auth_token()
     try:
-        jwks_payload = jwt.decode(token, options={'verify_signature': False})
-        assert 'jwks_host' in jwks_payload
-        jwks_host = jwks_payload.get('jwks_host')
-        key = get_public_key(jwks_host, token)
-        aud = request.url_root
-        payload = jwt.decode(
-            token, key=key, algorithms=['RS256'], audience=[aud.rstrip('/')]
-        )
-        set_ctr_entities_limit(payload)
-        set_aggregate(payload)
+        aud = request.url_root.rstrip('/')
+        payload = get_verified_payload(token, aud)
 
-        return payload['key']
+        return Settings.from_payload(payload)
     except tuple(expected_errors) as error:
         message = expected_errors[error.__class__]
         raise AuthorizationError(message)
 
 
+def get_key() -> Union[str, Exception]:
+    """Get the validated credentials of the request."""
+    return get_settings().key
+
+
 def get_json(schema):
     """
     Parse the incoming request's data as JSON.
@@ -138,6 +255,24 @@ def get_json(schema):
     return data
 
 
+def jsonify(data):
+    """
+    Create a JSON response like `flask.jsonify` does,
+    encoding it with the fastest JSON codec available.
+
+    """
+    config = current_app.config
+    if (current_app.debug
+            or config['JSONIFY_PRETTYPRINT_REGULAR']
+            or not config['JSON_AS_ASCII']):
+        return flask.jsonify(data)
+
+    return current_app.response_class(
+        codec.dumps(data, sort_keys=config['JSON_SORT_KEYS']) + b'\n',
+        mimetype=config['JSONIFY_MIMETYPE']
+    )
+
+
 def jsonify_data(data):
     return jsonify({'data': data})
 
@@ -161,6 +296,49 @@ def jsonify_result():
     return jsonify(result)
 
 
+def jsonify_result_stream(sightings, errors):
+    """
+    Stream the same document `jsonify_result` builds while the lists
+    of sightings are being produced, the count goes after the docs.
+    An error raised meanwhile ends up in the errors, the status is already
+    sent, so an unexpected one is reported as an unknown fatal error.
+
+    """
+    logger = current_app.logger
+
+    def generate():
+        count = 0
+        try:
+            with closing(sightings):
+                for chunk in sightings:
+                    for doc in chunk:
+                        yield (b',' if count else
+                               b'{"data":{"sightings":{"docs":[')
+                        yield codec.dumps(doc)
+                        count += 1
+        except TRFormattedError as error:
+            logger.error(error.json)
+            errors[:] = [error.json]
+        except Exception:
+            logger.error(traceback.format_exc())
+            errors[:] = [TRFormattedError(UNKNOWN, None).json]
+
+        if count:
+            yield b'],"count":%d}}' % count
+            if errors:
+                yield b',"errors":' + codec.dumps(errors)
+            yield b'}\n'
+        elif errors:
+            yield b'{"errors":' + codec.dumps(errors) + b'}\n'
+        else:
+            yield b'{"data":{}}\n'
+
+    return current_app.response_class(
+        generate(),
+        mimetype=current_app.config['JSONIFY_MIMETYPE']
+    )
+
+
 def format_docs(docs):
     return {'count': len(docs), 'docs': docs}
 
@@ -170,12 +348,3 @@ def join_url(base, *parts):
         [base.rstrip('/')] +
         [part.strip('/') for part in parts]
     )
-
-
-def all_subclasses(cls):
-    """
-    Retrieve set of class subclasses recursively.
-
-    """
-    subclasses = set(cls.__subclasses__())
-    return subclasses.union(s for c in subclasses for s in all_subclasses(c))
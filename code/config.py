@@ -6,13 +6,10 @@ class Config:
     VERSION = settings["VERSION"]
 
     API_URL = 'https://api.dnsdb.info/'
+    # 2 looks records up with DNSDB API v2 which tells incomplete results.
+    FARSIGHT_API_VERSION = 1
 
     UI_SEARCH_URL = 'https://scout.dnsdb.info/?seed={query}'
-    FARSIGHT_OBSERVABLES = {
-        'ip': 'IP',
-        'ipv6': 'IPv6',
-        'domain': 'domain'
-    }
 
     USER_AGENT = ('SecureX Threat Response Integrations '
                   '<tr-integrations-support@cisco.com>')
@@ -21,3 +18,63 @@ class Config:
     CTR_ENTITIES_LIMIT_MAX = 1000
     CTR_ENTITIES_LIMIT_DEFAULT = 100
     NUMBER_OF_DAYS_FOR_FARSIGHT_TIME_FILTER = 90
+
+    FARSIGHT_CLIENTS_CACHE_SIZE = 64
+    FARSIGHT_POOL_CONNECTIONS = 1
+    FARSIGHT_POOL_MAXSIZE = 10
+    FARSIGHT_MAX_CONCURRENT_LOOKUPS = 10
+    FARSIGHT_MAX_RECORDS = 10000
+    FARSIGHT_MAX_BYTES = 32 * 1024 * 1024
+    FARSIGHT_TIMEOUT = 30
+    # Records per DNSDB request, the lookups of up to FARSIGHT_MAX_RECORDS
+    # records are made page by page if set.
+    FARSIGHT_PAGE_SIZE = None
+
+    # Seconds all the upstream calls of a request must end in,
+    # the JWT may set it with REQUEST_DEADLINE up to the maximum.
+    REQUEST_DEADLINE_DEFAULT = 20
+    REQUEST_DEADLINE_MAX = 55
+
+    JWKS_TIMEOUT = 5
+    JWKS_CACHE_TTL = 3600
+    JWKS_CACHE_MIN_REFRESH_INTERVAL = 60
+    TOKEN_CACHE_TTL = 300
+
+    # `memory` keeps the cache per worker, `sqlite` shares it
+    # between all the workers of a container through FARSIGHT_CACHE_PATH.
+    FARSIGHT_CACHE_BACKEND = 'memory'
+    FARSIGHT_CACHE_PATH = '/tmp/farsight-dnsdb-cache.sqlite3'
+    FARSIGHT_CACHE_MAX_VALUE_SIZE = 4 * 1024 * 1024
+    FARSIGHT_CACHE_TTL = 300
+    FARSIGHT_CACHE_SIZE = 1024
+    FARSIGHT_CACHE_MAX_RECORDS = 10000
+    # Records held by the memory cache of a worker in total.
+    FARSIGHT_CACHE_MAX_TOTAL_RECORDS = 100000
+    FARSIGHT_TIME_FILTER_GRANULARITY = 3600
+
+    # Token bucket per API key in front of DNSDB, shared like the cache.
+    # It follows the burst quota DNSDB reports for a key once the key
+    # has been rate limited, CAPACITY and RATE set a bucket for the keys
+    # without a known quota (none by default).
+    FARSIGHT_RATE_LIMIT_BACKEND = 'memory'
+    FARSIGHT_RATE_LIMIT_CAPACITY = None
+    FARSIGHT_RATE_LIMIT_RATE = None
+    FARSIGHT_RATE_LIMIT_QUOTA_TTL = 300
+    FARSIGHT_RETRY_BUDGET = 10
+    FARSIGHT_BACKOFF_BASE = 0.5
+    FARSIGHT_BACKOFF_MAX = 5
+
+    # Circuit breaker shared by the lookups of a worker, it opens
+    # when FAILURE_RATE of the last WINDOW calls failed or were slow.
+    FARSIGHT_BREAKER_WINDOW = 20
+    FARSIGHT_BREAKER_MIN_CALLS = 5
+    FARSIGHT_BREAKER_FAILURE_RATE = 0.5
+    FARSIGHT_BREAKER_SLOW_CALL_DURATION = 10
+    FARSIGHT_BREAKER_OPEN_DURATION = 30
+
+    STREAM_OBSERVE_RESPONSE = False
+
+    # `quota` checks DNSDB with the rate_limit endpoint and caches
+    # the result for HEALTH_CACHE_TTL, `lookup` runs a real lookup.
+    HEALTH_CHECK = 'quota'
+    HEALTH_CACHE_TTL = 30
@@ -0,0 +1,89 @@
+"""
+Micro-benchmarks of the enrichment hot path, run from the code folder:
+
+    python -m tests.benchmark [--save] [--threshold 0.5] [-k NAME]
+
+Every `bench_*` module yields named cases from `cases()`. Each case
+reports the best time of a call out of several repeats. The time is
+divided by the time of a fixed calibration loop measured right before,
+so the score hardly depends on how busy or fast the machine is.
+Scores are compared with baseline.json: the run fails if a case scores
+worse than its baseline by more than the threshold. --save stores
+the scores of the run as the new baseline.
+"""
+import json
+import sys
+from argparse import ArgumentParser
+from importlib import import_module
+from pathlib import Path
+from timeit import Timer
+
+BASELINE = Path(__file__).with_name('baseline.json')
+REPEAT = 5
+
+
+def collect(keyword=None):
+    for path in sorted(Path(__file__).parent.glob('bench_*.py')):
+        module = import_module(f'{__package__}.{path.stem}')
+        for name, function in module.cases():
+            if not keyword or keyword in name:
+                yield name, function
+
+
+def calibration():
+    total = 0
+    for number in range(10000):
+        total += number * number % 7
+    return total
+
+
+def measure(function):
+    """Return the best time of a call in seconds."""
+    timer = Timer(function)
+    number, _ = timer.autorange()
+    return min(timer.repeat(REPEAT, number)) / number
+
+
+def main(argv=None):
+    parser = ArgumentParser(prog='python -m tests.benchmark')
+    parser.add_argument('--save', action='store_true',
+                        help='save the results as the baseline')
+    parser.add_argument('--threshold', type=float, default=0.5,
+                        help='allowed slowdown against the baseline')
+    parser.add_argument('-k', dest='keyword',
+                        help='run only the cases with it in the name')
+    args = parser.parse_args(argv)
+
+    baseline = json.loads(BASELINE.read_text()) if BASELINE.exists() else {}
+    results = {}
+    regressions = []
+    for name, function in collect(args.keyword):
+        reference = measure(calibration)
+        seconds = measure(function)
+        results[name] = seconds / reference
+
+        line = f'{name:<48} {seconds * 1000:>12.3f} ms'
+        if name in baseline:
+            ratio = results[name] / baseline[name]
+            line += f' {ratio:>8.2f}x'
+            if ratio > 1 + args.threshold:
+                regressions.append(name)
+                line += ' REGRESSION'
+        print(line, flush=True)
+
+    if args.save:
+        BASELINE.write_text(
+            json.dumps({**baseline, **results}, indent=2, sort_keys=True)
+            + '\n'
+        )
+
+    if regressions and not args.save:
+        print(f'{len(regressions)} case(s) slower than the baseline '
+              f'by more than {args.threshold:.0%}', file=sys.stderr)
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,21 @@
+from api.client import FarsightClient
+from tests.benchmark.fixtures import SHAPES, SIZES, Response, ndjson
+
+
+def cases():
+    """Parse streamed DNSDB responses into records."""
+    for shape, (observable, make_records) in SHAPES.items():
+        for size in SIZES:
+            lines = ndjson(make_records(size))
+            client = FarsightClient(
+                'https://api.dnsdb.info/', 'benchmark_key', 'benchmark'
+            )
+            client.session.get = (
+                lambda url, lines=lines, **kwargs: Response(lines)
+            )
+
+            def parse(client=client, observable=observable):
+                for _ in client.lookup(observable, stream=True):
+                    pass
+
+            yield f'client_parse[{shape}-{size}]', parse
@@ -0,0 +1,20 @@
+from api.mappings import Mapping, Record
+from tests.benchmark.fixtures import SHAPES, SIZES
+
+LIMIT = 100
+
+
+def cases():
+    """Map records to sightings in both sighting modes."""
+    for shape, (observable, make_records) in SHAPES.items():
+        mapping = Mapping.for_(observable)
+        for size in SIZES:
+            records = [Record.from_json(r) for r in make_records(size)]
+            for aggregate in (True, False):
+                def extract(records=records, aggregate=aggregate):
+                    mapping.extract_sightings(
+                        records, 'source_uri', LIMIT, aggregate
+                    )
+
+                yield (f'extract_sightings[{shape}-{size}-'
+                       f'{"aggr" if aggregate else "no_aggr"}]', extract)
@@ -0,0 +1,62 @@
+from unittest.mock import MagicMock, patch
+
+import jwt
+from flask import g
+
+import api.utils
+from api.mappings import Mapping, Record
+from api.utils import get_key, jsonify_result
+from app import app
+from tests.benchmark.fixtures import SHAPES, SIZES
+from tests.unit.mock_for_tests import (
+    EXPECTED_RESPONSE_OF_JWKS_ENDPOINT, PRIVATE_KEY
+)
+
+
+def _token():
+    return jwt.encode(
+        {'key': 'benchmark_key', 'jwks_host': 'visibility.amp.cisco.com',
+         'aud': 'http://localhost'},
+        PRIVATE_KEY, algorithm='RS256',
+        headers={'kid': EXPECTED_RESPONSE_OF_JWKS_ENDPOINT['keys'][0]['kid']}
+    )
+
+
+def cases():
+    """Verify JWTs and serialize the response of the enrichment."""
+    jwks = MagicMock()
+    jwks.json.return_value = EXPECTED_RESPONSE_OF_JWKS_ENDPOINT
+    headers = {'Authorization': f'Bearer {_token()}'}
+
+    def cached():
+        with app.test_request_context(headers=headers):
+            get_key()
+
+    with patch('requests.get', return_value=jwks):
+        cached()
+
+    def uncached():
+        # Cold keys: the public keys are fetched and parsed again
+        # and the token is verified with them.
+        api.utils._jwks_cache.clear()
+        api.utils._tokens_cache.clear()
+        with patch('requests.get', return_value=jwks):
+            cached()
+
+    yield 'get_key[cached]', cached
+    yield 'get_key[uncached]', uncached
+
+    observable, make_records = SHAPES['domain']
+    mapping = Mapping.for_(observable)
+    for size in SIZES:
+        sightings = mapping.extract_sightings(
+            [Record.from_json(r) for r in make_records(size)],
+            'source_uri', size, aggregate=False
+        )
+
+        def serialize(sightings=sightings):
+            with app.test_request_context():
+                g.sightings = sightings
+                jsonify_result()
+
+        yield f'jsonify_result[{len(sightings)}]', serialize
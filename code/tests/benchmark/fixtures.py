@@ -0,0 +1,71 @@
+import json
+from random import Random
+
+SIZES = (10, 1000, 100000)
+
+# Records are made in the same order on every run.
+SEED = 42
+
+
+def domain_records(size, seed=SEED):
+    """Return records of a domain resolving to many IP addresses."""
+    random = Random(seed)
+    for _ in range(size):
+        first = random.randrange(1262304000, 1577836800)
+        yield {
+            'count': random.randrange(1, 10000),
+            'time_first': first,
+            'time_last': first + random.randrange(0, 31536000),
+            'rrname': 'example.com.',
+            'rrtype': random.choice(('A', 'AAAA')),
+            'bailiwick': 'example.com.',
+            'rdata': [
+                f'10.{random.randrange(256)}.{random.randrange(256)}.'
+                f'{random.randrange(256)}'
+                for _ in range(random.randrange(1, 4))
+            ]
+        }
+
+
+def ip_records(size, seed=SEED):
+    """Return records of an IP address many hostnames resolve to."""
+    random = Random(seed)
+    for _ in range(size):
+        first = random.randrange(1262304000, 1577836800)
+        yield {
+            'count': random.randrange(1, 10000),
+            'zone_time_first': first,
+            'zone_time_last': first + random.randrange(0, 31536000),
+            'rrname': f'host-{random.randrange(size * 2)}.example.com.',
+            'rrtype': 'A',
+            'rdata': '10.0.0.1'
+        }
+
+
+SHAPES = {
+    'domain': ({'type': 'domain', 'value': 'example.com'}, domain_records),
+    'ip': ({'type': 'ip', 'value': '10.0.0.1'}, ip_records),
+}
+
+
+def ndjson(records):
+    """Return the lines of a DNSDB NDJSON response with the records."""
+    return [json.dumps(record).encode() for record in records]
+
+
+class Response:
+    """Streamed DNSDB response served from memory."""
+    ok = True
+    status_code = 200
+
+    def __init__(self, lines):
+        self.lines = lines
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def iter_lines(self, chunk_size=None):
+        return iter(self.lines)
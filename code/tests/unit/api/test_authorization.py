@@ -1,7 +1,15 @@
+from threading import Lock
+from time import monotonic
+
+import jwt
+
+import api.utils
 from .utils import headers
 from pytest import fixture
 from http import HTTPStatus
-from requests.exceptions import InvalidURL, ConnectionError
+from unittest.mock import patch
+from requests.exceptions import InvalidURL, ConnectionError, ReadTimeout
+from tests.unit.conftest import farsight_api_responses_by_value
 from api.utils import (
     NO_AUTH_HEADER,
     WRONG_AUTH_TYPE,
@@ -11,7 +19,10 @@ from api.utils import (
     WRONG_KEY,
     WRONG_JWT_STRUCTURE,
     WRONG_AUDIENCE,
-    KID_NOT_FOUND
+    KID_NOT_FOUND,
+    JWKS,
+    Settings,
+    get_public_key
 )
 
 
@@ -56,7 +67,7 @@ def test_call_with_wrong_jwks_host(
         route, client, valid_json, valid_jwt, mock_request,
         authorization_errors_expected_payload
 ):
-    for error in (ConnectionError, InvalidURL):
+    for error in (ConnectionError, InvalidURL, ReadTimeout):
         mock_request.side_effect = error()
 
         response = client.post(
@@ -163,3 +174,116 @@ def test_call_with_wrong_kid(
     assert response.json == authorization_errors_expected_payload(
         KID_NOT_FOUND
     )
+
+
+def test_call_with_cached_public_key(
+        route, client, valid_json, valid_jwt, mock_request,
+        mock_farsight_request, get_public_key, farsight_response_ok,
+        farsight_response_rate_limit
+):
+    mock_request.return_value = get_public_key
+    mock_farsight_request.side_effect = farsight_api_responses_by_value(
+        {'rate_limit': farsight_response_rate_limit},
+        default=farsight_response_ok
+    )
+
+    for _ in range(2):
+        response = client.post(
+            route, json=valid_json, headers=headers(valid_jwt())
+        )
+        assert response.status_code == HTTPStatus.OK
+        assert response.json.get('errors') is None
+
+    assert mock_request.call_count == 1
+
+
+def test_call_with_unknown_kid_refreshes_public_keys(
+        route, client, valid_json, valid_jwt, mock_request,
+        mock_farsight_request, get_public_key, farsight_response_ok
+):
+    mock_request.return_value = get_public_key
+    mock_farsight_request.return_value = farsight_response_ok
+    client.post(route, json=valid_json, headers=headers(valid_jwt()))
+
+    with patch.dict(client.application.config,
+                    JWKS_CACHE_MIN_REFRESH_INTERVAL=0):
+        client.post(
+            route, json=valid_json, headers=headers(valid_jwt(kid='new'))
+        )
+
+    assert mock_request.call_count == 2
+
+
+def test_public_keys_are_fetched_with_timeout(
+        route, client, valid_json, valid_jwt, mock_request,
+        mock_farsight_request, get_public_key, farsight_response_ok
+):
+    mock_request.return_value = get_public_key
+    mock_farsight_request.return_value = farsight_response_ok
+
+    client.post(route, json=valid_json, headers=headers(valid_jwt()))
+
+    assert mock_request.call_args.kwargs['timeout'] == (
+        client.application.config['JWKS_TIMEOUT']
+    )
+
+
+def test_cached_public_keys_do_not_wait_for_refresh(client):
+    with client.application.app_context(), \
+            patch('api.utils._fetch_public_keys') as fetch:
+        api.utils._jwks_cache.set(
+            'visibility.amp.cisco.com', JWKS({'kid': 'key'}, monotonic())
+        )
+        lock = api.utils._jwks_locks.get_or_create(
+            'visibility.amp.cisco.com', Lock
+        )
+        with lock:
+            assert get_public_key(
+                'visibility.amp.cisco.com',
+                jwt.encode({}, 'secret', headers={'kid': 'kid'})
+            ) == 'key'
+
+        fetch.assert_not_called()
+
+
+def test_call_with_cached_verified_token(
+        route, client, valid_json, valid_jwt, mock_request,
+        mock_farsight_request, get_public_key, farsight_response_ok
+):
+    mock_request.return_value = get_public_key
+    mock_farsight_request.return_value = farsight_response_ok
+    token = valid_jwt()
+    client.post(route, json=valid_json, headers=headers(token))
+
+    with patch('jwt.decode') as decode_mock:
+        response = client.post(route, json=valid_json, headers=headers(token))
+
+        decode_mock.assert_not_called()
+        assert response.json.get('errors') is None
+
+
+def test_settings_are_taken_from_payload(client):
+    with client.application.app_context():
+        assert Settings.from_payload({
+            'key': 'some_key', 'AGGREGATE': 'false',
+            'CTR_ENTITIES_LIMIT': 5000, 'REQUEST_DEADLINE': '5'
+        }) == Settings('some_key', 1000, False, 5)
+        assert Settings.from_payload({
+            'key': 'some_key', 'CTR_ENTITIES_LIMIT': -1,
+            'REQUEST_DEADLINE': None
+        }) == Settings('some_key', 100, True, 20)
+
+
+def test_call_does_not_change_app_config(
+        route, client, valid_json, valid_jwt, mock_request,
+        mock_farsight_request, get_public_key, farsight_response_ok
+):
+    mock_request.return_value = get_public_key
+    mock_farsight_request.return_value = farsight_response_ok
+    config = dict(client.application.config)
+
+    client.post(route, json=valid_json,
+                headers=headers(valid_jwt(aggregate=False,
+                                          ctr_entities_limit=1)))
+
+    assert dict(client.application.config) == config
@@ -0,0 +1,140 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
+from time import sleep
+from unittest.mock import patch
+
+from pytest import fixture, raises
+
+from api.cache import LRUCache, SQLiteCache, SingleFlight
+
+
+@fixture
+def sqlite_cache(tmp_path):
+    def _make_cache(maxsize=10, ttl=60, max_value_size=1024):
+        return SQLiteCache(
+            str(tmp_path / 'cache.sqlite3'), maxsize, ttl, max_value_size
+        )
+
+    return _make_cache
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+
+    assert cache.get('a') == 1
+    assert cache.get('b') is None
+    assert cache.get('c') == 3
+
+
+def test_lru_cache_expires_items():
+    cache = LRUCache(maxsize=2, ttl=0.01)
+    cache.set('a', 1)
+    sleep(0.02)
+
+    assert cache.get('a') is None
+    assert cache.stats['misses'] == 1
+
+
+def test_sqlite_cache_is_shared_between_instances(sqlite_cache):
+    key = ('hash', 'domain', 'google.com', 'lookup', None, 1)
+    sqlite_cache().set(key, [{'count': 1}])
+
+    assert sqlite_cache().get(key) == [{'count': 1}]
+
+
+def test_sqlite_cache_expires_items(sqlite_cache):
+    cache = sqlite_cache(ttl=0.01)
+    cache.set('a', 1)
+    sleep(0.02)
+
+    assert cache.get('a') is None
+
+
+def test_sqlite_cache_enforces_size_limits(sqlite_cache):
+    cache = sqlite_cache(maxsize=2, max_value_size=16)
+    cache.set('big', 'x' * 16)
+    for key in ('a', 'b', 'c'):
+        cache.set(key, key)
+
+    assert cache.get('big') is None
+    assert cache.get('a') is None
+    assert cache.get('b') == 'b'
+    assert cache.get('c') == 'c'
+
+
+def run_concurrently(flight, function, callers=4):
+    executor = ThreadPoolExecutor(max_workers=callers)
+    futures = [executor.submit(flight.do, 'key', function)
+               for _ in range(callers)]
+    executor.shutdown(wait=False)
+    sleep(0.05)
+    return futures
+
+
+def test_single_flight_shares_result():
+    flight = SingleFlight()
+    calls = []
+    release = Event()
+
+    def function():
+        calls.append(1)
+        release.wait(1)
+        return [{'count': 1}]
+
+    futures = run_concurrently(flight, function)
+    release.set()
+
+    assert all(f.result() == [{'count': 1}] for f in futures)
+    assert len(calls) == 1
+    assert len(flight) == 0
+
+
+def test_single_flight_shares_error():
+    flight = SingleFlight()
+    release = Event()
+
+    def function():
+        release.wait(1)
+        raise ValueError('upstream failed')
+
+    futures = run_concurrently(flight, function)
+    release.set()
+
+    for future in futures:
+        with raises(ValueError):
+            future.result()
+
+
+def test_lru_cache_is_bounded_by_total_weight():
+    cache = LRUCache(maxsize=10, maxweight=5)
+    cache.set('a', [1, 2])
+    cache.set('b', [1, 2])
+    cache.set('a', [1])
+    cache.set('c', [1, 2, 3])
+
+    assert cache.get('a') == [1]
+    assert cache.get('b') is None
+    assert cache.get('c') == [1, 2, 3]
+    assert cache.weight == 4
+
+    cache.set('d', list(range(6)))
+    assert cache.get('d') is None
+    assert cache.weight == 4
+
+
+def test_sqlite_cache_reuses_connections_between_threads(sqlite_cache):
+    cache = sqlite_cache()
+    for _ in range(3):
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            list(executor.map(cache.get, 'ab'))
+
+    assert cache._pool._idle.qsize() <= cache._pool.size
+    with patch('sqlite3.connect') as connect:
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            executor.submit(cache.get, 'a').result()
+
+    connect.assert_not_called()
@@ -0,0 +1,80 @@
+from time import sleep
+
+from pytest import raises
+
+from api.circuitbreaker import (
+    CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpenError
+)
+
+
+def make_breaker(**kwargs):
+    return CircuitBreaker((IOError,), window=4, min_calls=2,
+                          failure_rate=0.5, **kwargs)
+
+
+def succeed(breaker):
+    with breaker.call():
+        pass
+
+
+def fail(breaker, error=IOError):
+    with raises(error):
+        with breaker.call():
+            raise error
+
+
+def test_breaker_opens_at_failure_rate():
+    breaker = make_breaker()
+    succeed(breaker)
+    succeed(breaker)
+    fail(breaker)
+    assert breaker.state == CLOSED
+
+    fail(breaker)
+    assert breaker.state == OPEN
+    assert breaker.stats == {'state': OPEN, 'calls': 4, 'failure_rate': 0.5}
+    with raises(CircuitOpenError):
+        succeed(breaker)
+
+
+def test_breaker_counts_slow_calls_as_failures():
+    breaker = make_breaker(slow_call_duration=0)
+    succeed(breaker)
+    succeed(breaker)
+
+    assert breaker.state == OPEN
+
+
+def test_breaker_ignores_other_errors():
+    breaker = make_breaker()
+    fail(breaker, ValueError)
+    fail(breaker, ValueError)
+
+    assert breaker.stats == {'state': CLOSED, 'calls': 0, 'failure_rate': 0}
+
+
+def test_breaker_half_opens_for_a_single_probe():
+    breaker = make_breaker(open_duration=0.01)
+    fail(breaker)
+    fail(breaker)
+    sleep(0.02)
+
+    with breaker.call():
+        assert breaker.state == HALF_OPEN
+        with raises(CircuitOpenError):
+            succeed(breaker)
+
+    assert breaker.state == CLOSED
+    assert breaker.stats['calls'] == 0
+
+
+def test_breaker_reopens_on_failed_probe():
+    breaker = make_breaker(open_duration=0.01)
+    fail(breaker)
+    fail(breaker)
+    sleep(0.02)
+    fail(breaker)
+
+    assert breaker.state == OPEN
+    with raises(CircuitOpenError):
+        succeed(breaker)
@@ -0,0 +1,560 @@
+import json
+from http import HTTPStatus
+from time import monotonic, sleep, time
+from unittest.mock import MagicMock
+
+from pytest import raises
+from requests.exceptions import Timeout
+
+from api.cache import LRUCache, SQLiteCache
+from api.circuitbreaker import CircuitBreaker
+from api.client import FarsightClient, _bucket_for, get_client
+from api.errors import (
+    TOO_MANY_REQUESTS,
+    UNAVAILABLE,
+    CriticalFarsightResponseError,
+    FarsightLookupFailedError,
+    FarsightRateLimitError,
+    FarsightTimeoutError,
+    FarsightUnavailableError
+)
+from api.mappings import Record
+from api.ratelimit import RateLimiter, TokenBuckets
+from tests.unit.conftest import (
+    farsight_api_error_mock, farsight_api_response_mock,
+    farsight_api_responses_by_value
+)
+
+
+def test_get_client_is_reused_per_api_key(client):
+    with client.application.app_context():
+        assert get_client('some_key') is get_client('some_key')
+        assert get_client('some_key') is not get_client('other_key')
+
+
+def test_get_client_evicts_least_recently_used(client):
+    app = client.application
+    with app.app_context():
+        first = get_client('first_key')
+        for i in range(app.config['FARSIGHT_CLIENTS_CACHE_SIZE']):
+            get_client(f'key_{i}')
+
+        assert get_client('first_key') is not first
+
+
+def test_lookup_is_cached(client, mock_farsight_request, farsight_response_ok):
+    mock_farsight_request.return_value = farsight_response_ok
+    observable = {'type': 'domain', 'value': 'google.com'}
+
+    with client.application.app_context():
+        farsight_client = get_client('some_key')
+        first = farsight_client.lookup(observable, 90)
+        second = farsight_client.lookup(observable, 90)
+
+        assert first == second
+        assert mock_farsight_request.call_count == 1
+        assert farsight_client.cache.stats['hits'] == 1
+        assert farsight_client.cache.stats['misses'] == 1
+
+        farsight_client.lookup(observable, limit=1)
+        assert mock_farsight_request.call_count == 2
+
+
+def test_time_filter_is_rounded(client):
+    with client.application.app_context():
+        farsight_client = get_client('some_key')
+        start = farsight_client._time_last_after(90)
+
+        assert start % farsight_client.time_filter_granularity == 0
+        assert start == farsight_client._time_last_after(90)
+
+
+def record(count):
+    return {'count': count, 'rrname': 'google.com.', 'rrtype': 'A',
+            'rdata': ['127.0.0.1'], 'time_first': 1, 'time_last': 2}
+
+
+def test_lookup_stream_stops_at_max_records(mock_farsight_request):
+    response = farsight_api_response_mock(
+        HTTPStatus.OK,
+        payload=[record(i) for i in range(5)]
+    )
+    mock_farsight_request.return_value = response
+    farsight_client = FarsightClient(
+        'https://api.dnsdb.info/', 'some_key', 'agent', max_records=2
+    )
+
+    records = farsight_client.lookup(
+        {'type': 'domain', 'value': 'google.com'}, stream=True
+    )
+
+    assert [r.count for r in records] == [0, 1]
+    assert mock_farsight_request.call_args.kwargs['stream']
+    response.__exit__.assert_called_once()
+
+
+def test_lookup_stream_stops_at_max_bytes(mock_farsight_request):
+    mock_farsight_request.return_value = farsight_api_response_mock(
+        HTTPStatus.OK, payload=[record(i) for i in range(5)]
+    )
+    farsight_client = FarsightClient(
+        'https://api.dnsdb.info/', 'some_key', 'agent',
+        max_bytes=len(json.dumps(record(0))) * 3
+    )
+
+    records = farsight_client.lookup(
+        {'type': 'domain', 'value': 'google.com'}, stream=True
+    )
+
+    assert len(list(records)) == 3
+
+
+def test_lookup_restores_records_from_shared_cache(
+        tmp_path, mock_farsight_request
+):
+    mock_farsight_request.return_value = farsight_api_response_mock(
+        HTTPStatus.OK, payload=[record(1)]
+    )
+    farsight_client = FarsightClient(
+        'https://api.dnsdb.info/', 'some_key', 'agent',
+        cache=SQLiteCache(str(tmp_path / 'cache.sqlite3'), 10, 60, 1024),
+        cache_max_records=10
+    )
+    observable = {'type': 'domain', 'value': 'google.com'}
+
+    assert (farsight_client.lookup(observable)
+            == farsight_client.lookup(observable)
+            == [Record.from_json(record(1))])
+    assert mock_farsight_request.call_count == 1
+
+
+def test_lookup_is_cached_without_per_entry_bound(mock_farsight_request):
+    mock_farsight_request.return_value = farsight_api_response_mock(
+        HTTPStatus.OK, payload=[record(1)]
+    )
+    farsight_client = FarsightClient(
+        'https://api.dnsdb.info/', 'some_key', 'agent',
+        cache=LRUCache(maxsize=10)
+    )
+    observable = {'type': 'domain', 'value': 'google.com'}
+
+    assert (farsight_client.lookup(observable)
+            == farsight_client.lookup(observable)
+            == [Record.from_json(record(1))])
+    assert mock_farsight_request.call_count == 1
+
+
+def rate_limited_response(retry_after=None):
+    response = farsight_api_error_mock(
+        HTTPStatus.TOO_MANY_REQUESTS, 'Error: Rate limit exceeded'
+    )
+    response.headers = {'Retry-After': retry_after} if retry_after else {}
+    return response
+
+
+def test_rate_limited_lookup_is_retried_with_backoff(mock_farsight_request):
+    mock_farsight_request.side_effect = [
+        rate_limited_response(),
+        farsight_api_response_mock(HTTPStatus.OK, payload=[record(1)])
+    ]
+    farsight_client = FarsightClient(
+        'https://api.dnsdb.info/', 'some_key', 'agent', backoff_base=0.01
+    )
+
+    records = farsight_client.lookup(
+        {'type': 'domain', 'value': 'google.com'}, retry_until=time() + 1
+    )
+
+    assert records == [Record.from_json(record(1))]
+    assert mock_farsight_request.call_count == 2
+
+
+def test_rate_limited_lookup_fails_out_of_budget(mock_farsight_request):
+    mock_farsight_request.return_value = rate_limited_response('60')
+    farsight_client = FarsightClient(
+        'https://api.dnsdb.info/', 'some_key', 'agent'
+    )
+
+    with raises(CriticalFarsightResponseError) as error:
+        farsight_client.lookup(
+            {'type': 'domain', 'value': 'google.com'},
+            retry_until=time() + 1
+        )
+
+    assert error.value.code == TOO_MANY_REQUESTS
+    assert mock_farsight_request.call_count == 1
+
+
+def test_exhausted_quota_fails_without_requests(mock_farsight_request):
+    quota = MagicMock(ok=True)
+    quota.__enter__.return_value = quota
+    quota.json.return_value = {
+        'rate': {'limit': 1000, 'remaining': 0, 'reset': 1433980800}
+    }
+    mock_farsight_request.side_effect = [rate_limited_response(), quota]
+    farsight_client = FarsightClient(
+        'https://api.dnsdb.info/', 'some_key', 'agent',
+        rate_limiter=RateLimiter(TokenBuckets(), capacity=10, rate=10)
+    )
+    observable = {'type': 'domain', 'value': 'google.com'}
+
+    with raises(CriticalFarsightResponseError):
+        farsight_client.lookup(observable)
+    with raises(FarsightRateLimitError):
+        farsight_client.lookup(observable)
+
+    assert farsight_client.quota == (0, 0)
+    assert mock_farsight_request.call_args.args[0] == (
+        'https://api.dnsdb.info/lookup/rate_limit'
+    )
+
+
+def test_keys_without_quota_are_not_rate_limited(mock_farsight_request):
+    mock_farsight_request.side_effect = (
+        lambda *args, **kwargs: farsight_api_response_mock(
+            HTTPStatus.OK, payload=[record(1)]
+        )
+    )
+    farsight_client = FarsightClient(
+        'https://api.dnsdb.info/', 'some_key', 'agent',
+        rate_limiter=RateLimiter(TokenBuckets())
+    )
+
+    start = time()
+    for _ in range(20):
+        farsight_client.lookup(
+            {'type': 'domain', 'value': 'google.com'}, retry_until=time()
+        )
+
+    assert time() - start < 1
+    assert mock_farsight_request.call_count == 20
+
+
+def test_waiting_for_a_token_out_of_budget_times_out(mock_farsight_request):
+    mock_farsight_request.return_value = farsight_api_response_mock(
+        HTTPStatus.OK, payload=[record(1)]
+    )
+    farsight_client = FarsightClient(
+        'https://api.dnsdb.info/', 'some_key', 'agent',
+        rate_limiter=RateLimiter(TokenBuckets())
+    )
+    farsight_client.quota = (1, 0.001)
+    farsight_client._quota_expires_at = monotonic() + 60
+    observable = {'type': 'domain', 'value': 'google.com'}
+
+    farsight_client.lookup(observable)
+    with raises(FarsightTimeoutError):
+        farsight_client.lookup(observable, retry_until=time() + 0.1)
+
+    assert mock_farsight_request.call_count == 1
+
+
+def test_bucket_follows_burst_quota():
+    assert _bucket_for(
+        {'limit': 1000, 'remaining': 999, 'burst_size': 10,
+         'burst_window': 300}
+    ) == (10, 10 / 300)
+    assert _bucket_for(
+        {'limit': 'unlimited', 'remaining': 'n/a', 'reset': 'n/a'}
+    ) == (None, None)
+
+
+def test_lookup_fails_past_deadline(mock_farsight_request):
+    farsight_client = FarsightClient(
+        'https://api.dnsdb.info/', 'some_key', 'agent'
+    )
+
+    with raises(FarsightTimeoutError):
+        farsight_client.lookup(
+            {'type': 'domain', 'value': 'google.com'}, deadline=time()
+        )
+
+    mock_farsight_request.assert_not_called()
+
+
+def test_lookup_stream_stops_at_deadline(mock_farsight_request):
+    mock_farsight_request.return_value = farsight_api_response_mock(
+        HTTPStatus.OK, payload=[record(i) for i in range(2)]
+    )
+    farsight_client = FarsightClient(
+        'https://api.dnsdb.info/', 'some_key', 'agent', timeout=5
+    )
+
+    records = farsight_client.lookup(
+        {'type': 'domain', 'value': 'google.com'}, stream=True,
+        deadline=time() + 0.1
+    )
+
+    assert next(records).count == 0
+    assert 0 < mock_farsight_request.call_args.kwargs['timeout'] <= 0.1
+    sleep(0.1)
+    with raises(FarsightTimeoutError):
+        next(records)
+
+
+def test_circuit_breaker_fails_fast_after_server_errors(
+        mock_farsight_request
+):
+    mock_farsight_request.return_value = farsight_api_error_mock(
+        HTTPStatus.SERVICE_UNAVAILABLE, 'Error: Service Unavailable'
+    )
+    farsight_client = FarsightClient(
+        'https://api.dnsdb.info/', 'some_key', 'agent',
+        breaker=CircuitBreaker(
+            (CriticalFarsightResponseError,), window=2, min_calls=2
+        )
+    )
+    observable = {'type': 'domain', 'value': 'google.com'}
+
+    for _ in range(2):
+        with raises(CriticalFarsightResponseError):
+            farsight_client.lookup(observable)
+    with raises(FarsightUnavailableError) as error:
+        farsight_client.lookup(observable)
+
+    assert error.value.code == UNAVAILABLE
+    assert mock_farsight_request.call_count == 2
+
+
+def saf_lookup(mock_farsight_request, lines, **kwargs):
+    mock_farsight_request.return_value = farsight_api_response_mock(
+        HTTPStatus.OK, payload=lines
+    )
+    farsight_client = FarsightClient(
+        'https://api.dnsdb.info/', 'some_key', 'agent', api_version=2,
+        **kwargs
+    )
+    return farsight_client.lookup(
+        {'type': 'domain', 'value': 'google.com'}, stream=True
+    )
+
+
+def test_saf_lookup_succeeds(mock_farsight_request):
+    records = saf_lookup(mock_farsight_request, [
+        {'cond': 'begin'}, {'obj': record(1)}, {'cond': 'ongoing'},
+        {'obj': record(2)}, {'cond': 'succeeded'}, {'obj': record(3)}
+    ])
+
+    assert [r.count for r in records] == [1, 2]
+    assert not records.limited
+    assert mock_farsight_request.call_args.args[0] == (
+        'https://api.dnsdb.info/dnsdb/v2/lookup/rrset/name/google.com'
+    )
+    assert (mock_farsight_request.call_args.kwargs['headers']['Accept']
+            == 'application/x-ndjson')
+
+
+def test_saf_lookup_reports_truncation(mock_farsight_request):
+    limited = saf_lookup(mock_farsight_request, [
+        {'cond': 'begin'}, {'obj': record(1)},
+        {'cond': 'limited', 'msg': 'Result limit reached'}
+    ])
+    incomplete = saf_lookup(mock_farsight_request, [
+        {'cond': 'begin'}, {'obj': record(1)}
+    ])
+    capped = saf_lookup(mock_farsight_request, [
+        {'cond': 'begin'}, {'obj': record(1)}, {'obj': record(2)}
+    ], max_records=1)
+
+    for records in (limited, incomplete, capped):
+        assert [r.count for r in records] == [1]
+        assert records.limited
+
+
+def test_saf_lookup_fails(mock_farsight_request):
+    records = saf_lookup(mock_farsight_request, [
+        {'cond': 'begin'}, {'cond': 'failed', 'msg': 'Server error'}
+    ])
+
+    with raises(FarsightLookupFailedError) as error:
+        list(records)
+
+    assert error.value.message == (
+        'Farsight DNSDB failed to complete the lookup: Server error'
+    )
+
+
+def test_limited_lookup_is_cached_as_limited(
+        tmp_path, mock_farsight_request
+):
+    mock_farsight_request.return_value = farsight_api_response_mock(
+        HTTPStatus.OK,
+        payload=[{'obj': record(1)}, {'cond': 'limited'}]
+    )
+    farsight_client = FarsightClient(
+        'https://api.dnsdb.info/', 'some_key', 'agent', api_version=2,
+        cache=SQLiteCache(str(tmp_path / 'cache.sqlite3'), 10, 60, 1024),
+        cache_max_records=10
+    )
+    observable = {'type': 'domain', 'value': 'google.com'}
+
+    farsight_client.lookup(observable)
+    records = farsight_client.lookup(observable)
+
+    assert records == [Record.from_json(record(1))]
+    assert records.limited
+    assert mock_farsight_request.call_count == 1
+
+
+def test_paged_lookup_requests_pages_lazily(mock_farsight_request):
+    def side_effect(url, params, **kwargs):
+        offset = params.get('offset', 0)
+        return farsight_api_response_mock(HTTPStatus.OK, payload=[
+            record(i) for i in range(offset, min(offset + params['limit'], 5))
+        ])
+
+    mock_farsight_request.side_effect = side_effect
+    farsight_client = FarsightClient(
+        'https://api.dnsdb.info/', 'some_key', 'agent'
+    )
+
+    records = farsight_client.lookup(
+        {'type': 'domain', 'value': 'google.com'}, limit=10,
+        stream=True, page_size=2
+    )
+
+    # The first page is requested by the thread of the lookup.
+    assert mock_farsight_request.call_count == 1
+    assert [next(records).count for _ in range(2)] == [0, 1]
+    assert mock_farsight_request.call_count == 1
+    assert [r.count for r in records] == [2, 3, 4]
+    assert [call.kwargs['params'].get('offset')
+            for call in mock_farsight_request.call_args_list] == [None, 2, 4]
+    assert not records.limited
+
+
+def test_paged_lookup_stops_at_limit(mock_farsight_request):
+    mock_farsight_request.side_effect = (
+        lambda url, params, **kwargs: farsight_api_response_mock(
+            HTTPStatus.OK, payload=[record(1)] * params['limit']
+        )
+    )
+    farsight_client = FarsightClient(
+        'https://api.dnsdb.info/', 'some_key', 'agent'
+    )
+
+    records = farsight_client.lookup(
+        {'type': 'domain', 'value': 'google.com'}, limit=5, page_size=2
+    )
+
+    assert len(records) == 5
+    assert records.limited
+    assert [call.kwargs['params']['limit']
+            for call in mock_farsight_request.call_args_list] == [2, 2, 1]
+
+
+def test_circuit_breaker_ignores_request_deadline(mock_farsight_request):
+    breaker = CircuitBreaker(
+        (FarsightTimeoutError,), window=2, min_calls=2
+    )
+    farsight_client = FarsightClient(
+        'https://api.dnsdb.info/', 'some_key', 'agent', breaker=breaker
+    )
+    observable = {'type': 'domain', 'value': 'google.com'}
+
+    for _ in range(3):
+        with raises(FarsightTimeoutError):
+            farsight_client.lookup(observable, deadline=time() - 1)
+
+    mock_farsight_request.side_effect = Timeout
+    for _ in range(3):
+        with raises(FarsightTimeoutError):
+            farsight_client.lookup(observable, deadline=time() + 1)
+
+    assert breaker.stats == {'state': 'closed', 'calls': 0,
+                             'failure_rate': 0}
+
+    for _ in range(2):
+        with raises(FarsightTimeoutError):
+            farsight_client.lookup(observable)
+
+    assert breaker.stats['state'] == 'open'
+
+
+def test_quota_is_refreshed_once_per_ttl(mock_farsight_request):
+    quota = MagicMock(ok=True)
+    quota.__enter__.return_value = quota
+    quota.json.return_value = {
+        'rate': {'limit': 'unlimited', 'burst_size': 100,
+                 'burst_window': 1}
+    }
+    mock_farsight_request.side_effect = farsight_api_responses_by_value(
+        {'rate_limit': quota}, default=rate_limited_response()
+    )
+    farsight_client = FarsightClient(
+        'https://api.dnsdb.info/', 'some_key', 'agent', backoff_base=0.01,
+        rate_limiter=RateLimiter(TokenBuckets(), capacity=10, rate=10)
+    )
+    deadline = time() + 0.5
+
+    with raises(CriticalFarsightResponseError):
+        farsight_client.lookup(
+            {'type': 'domain', 'value': 'google.com'},
+            retry_until=deadline, deadline=deadline
+        )
+
+    urls = [call.args[0] for call in mock_farsight_request.call_args_list]
+    assert urls.count('https://api.dnsdb.info/lookup/rate_limit') == 1
+    assert len(urls) > 3
+    assert all(call.kwargs['timeout'] <= 0.5
+               for call in mock_farsight_request.call_args_list)
+
+
+def test_paged_lookup_stops_at_offset_max(mock_farsight_request):
+    def side_effect(url, params, **kwargs):
+        if params.get('offset', 0) >= 4:
+            response = farsight_api_response_mock(
+                HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE
+            )
+            response.status_code = HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE
+            return response
+        return farsight_api_response_mock(
+            HTTPStatus.OK, payload=[record(1)] * params['limit']
+        )
+
+    mock_farsight_request.side_effect = side_effect
+    farsight_client = FarsightClient(
+        'https://api.dnsdb.info/', 'some_key', 'agent'
+    )
+
+    records = farsight_client.lookup(
+        {'type': 'domain', 'value': 'google.com'}, limit=10, page_size=2
+    )
+
+    assert len(records) == 4
+    assert records.limited
+
+
+def test_paged_lookup_without_limit_stops_at_max_records(
+        mock_farsight_request
+):
+    mock_farsight_request.side_effect = (
+        lambda url, params, **kwargs: farsight_api_response_mock(
+            HTTPStatus.OK, payload=[record(1)] * params['limit']
+        )
+    )
+    farsight_client = FarsightClient(
+        'https://api.dnsdb.info/', 'some_key', 'agent', max_records=5
+    )
+
+    records = farsight_client.lookup(
+        {'type': 'domain', 'value': 'google.com'}, page_size=2
+    )
+
+    assert len(records) == 5
+    assert records.limited
+    assert mock_farsight_request.call_count == 3
+
+
+def test_unconsumed_record_stream_closes_response(mock_farsight_request):
+    response = farsight_api_response_mock(HTTPStatus.OK, payload=[record(1)])
+    mock_farsight_request.return_value = response
+    farsight_client = FarsightClient(
+        'https://api.dnsdb.info/', 'some_key', 'agent'
+    )
+
+    farsight_client.lookup(
+        {'type': 'domain', 'value': 'google.com'}, stream=True
+    ).close()
+
+    response.close.assert_called_once()
@@ -0,0 +1,40 @@
+from unittest.mock import patch
+
+from flask import json
+from pytest import fixture
+
+from api import codec
+
+
+def documents():
+    yield {'data': {'sightings': {'count': 1, 'docs': [{'b': 1, 'a': None}]}}}
+    yield {'errors': [{'message': 'Résolution échouée', 'type': 'fatal'}]}
+    yield [1, 'two', True, ('tuple',)]
+
+
+@fixture(params=documents())
+def document(request):
+    return request.param
+
+
+@fixture(params=(True, False), ids=('orjson', 'stdlib'))
+def with_orjson(request):
+    if request.param:
+        yield
+    else:
+        with patch.object(codec, 'orjson', None):
+            yield
+
+
+def test_dumps_matches_flask(client, document, with_orjson):
+    with client.application.app_context():
+        assert codec.dumps(document) == json.dumps(
+            document, separators=(',', ':')
+        ).encode()
+
+
+def test_loads(document, with_orjson):
+    encoded = codec.dumps(document)
+
+    assert codec.loads(encoded) == codec.loads(encoded.decode())
+    assert codec.loads(encoded) == json.loads(encoded)
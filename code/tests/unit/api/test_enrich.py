@@ -1,8 +1,12 @@
 from http import HTTPStatus
+from time import sleep
 from unittest.mock import patch
 
 from pytest import fixture
 
+from tests.unit.conftest import (
+    farsight_api_response_mock, farsight_api_responses_by_value
+)
 from .utils import headers
 
 
@@ -16,6 +20,13 @@ def route(request):
     return request.param
 
 
+@fixture(params=(False, True), ids=('jsonify', 'stream'))
+def stream_response(request, client):
+    with patch.dict(client.application.config,
+                    STREAM_OBSERVE_RESPONSE=request.param):
+        yield request.param
+
+
 def test_enrich_call_with_valid_jwt_but_invalid_json_failure(
         route, client, valid_jwt, invalid_json, invalid_json_expected_payload,
         mock_request, get_public_key
@@ -33,48 +44,44 @@ def test_enrich_call_with_valid_jwt_but_invalid_json_failure(
 def test_enrich_call_success(
         route, client, valid_jwt, valid_json,
         farsight_response_ok, success_enrich_expected_payload,
-        get_public_key
+        mock_request, mock_farsight_request, get_public_key
 ):
-    with patch('requests.get') as get_mock:
-        get_mock.side_effect = (
-            get_public_key,
-            farsight_response_ok
-        )
+    mock_request.return_value = get_public_key
+    mock_farsight_request.side_effect = farsight_api_responses_by_value({
+        'google.com/A': farsight_response_ok
+    })
 
-        response = client.post(
-            route, headers=headers(valid_jwt()), json=valid_json
-        )
+    response = client.post(
+        route, headers=headers(valid_jwt()), json=valid_json
+    )
 
-        assert response.status_code == HTTPStatus.OK
+    assert response.status_code == HTTPStatus.OK
 
-        response = response.get_json()
-        assert response.get('errors') is None
+    response = response.get_json()
+    assert response.get('errors') is None
 
-        if response.get('data') and isinstance(response['data'], dict):
-            assert response['data']['sightings']['docs'][0].pop('id')
-            assert response['data']['sightings']['docs'][0].pop(
-                'observed_time')
+    if response.get('data') and isinstance(response['data'], dict):
+        assert response['data']['sightings']['docs'][0].pop('id')
+        assert response['data']['sightings']['docs'][0].pop(
+            'observed_time')
 
-        assert response == success_enrich_expected_payload
+    assert response == success_enrich_expected_payload
 
 
 def test_enrich_success_with_not_found(
-        client, valid_jwt, valid_json,
-        farsight_response_not_found, get_public_key
+        client, valid_jwt, valid_json, farsight_response_not_found,
+        mock_request, mock_farsight_request, get_public_key, stream_response
 ):
-    with patch('requests.get') as get_mock:
-        get_mock.side_effect = (
-            get_public_key,
-            farsight_response_not_found
-        )
+    mock_request.return_value = get_public_key
+    mock_farsight_request.return_value = farsight_response_not_found
 
-        response = client.post(
-            '/observe/observables',
-            headers=headers(valid_jwt()), json=valid_json
-        )
+    response = client.post(
+        '/observe/observables',
+        headers=headers(valid_jwt()), json=valid_json
+    )
 
-        assert response.status_code == HTTPStatus.OK
-        assert response.json == {'data': {}}
+    assert response.status_code == HTTPStatus.OK
+    assert response.json == {'data': {}}
 
 
 @fixture(scope='module')
@@ -87,25 +94,212 @@ def valid_json_multiple():
 def test_enrich_call_success_with_extended_error_handling(
         client, valid_jwt, valid_json_multiple, farsight_response_ok,
         farsight_response_unauthorized_creds, farsight_response_not_found,
-        success_enrich_body, unauthorized_creds_body, get_public_key
+        success_enrich_body, unauthorized_creds_body,
+        mock_request, mock_farsight_request, get_public_key, stream_response
+):
+    mock_request.return_value = get_public_key
+    mock_farsight_request.side_effect = farsight_api_responses_by_value({
+        'google.com/A': farsight_response_ok,
+        '1': farsight_response_not_found,
+        'farsight.com': farsight_response_unauthorized_creds
+    })
+
+    response = client.post(
+        '/observe/observables', headers=headers(valid_jwt()),
+        json=valid_json_multiple
+    )
+
+    assert response.status_code == HTTPStatus.OK
+
+    response = response.get_json()
+
+    assert response['data']['sightings']['docs'][0].pop('id')
+    assert response['data']['sightings']['docs'][0].pop('observed_time')
+
+    assert response['data'] == success_enrich_body['data']
+    assert response['errors'] == unauthorized_creds_body['errors']
+
+
+def test_enrich_call_keeps_order_of_concurrent_lookups(
+        client, valid_jwt, farsight_response_ok, get_public_key,
+        mock_request, mock_farsight_request, stream_response
+):
+    observables = [{'type': 'domain', 'value': 'slow.com'},
+                   {'type': 'domain', 'value': 'google.com'}]
+
+    def slow_response(*args, **kwargs):
+        sleep(0.1)
+        return farsight_response_ok
+
+    responses = farsight_api_responses_by_value({
+        'google.com/A': farsight_response_ok
+    })
+    mock_request.return_value = get_public_key
+    mock_farsight_request.side_effect = (
+        lambda url, *args, **kwargs:
+        slow_response() if 'slow.com/A' in url else responses(url)
+    )
+
+    response = client.post(
+        '/observe/observables', headers=headers(valid_jwt()),
+        json=observables
+    )
+
+    docs = response.get_json()['data']['sightings']['docs']
+    assert [doc['observables'] for doc in docs] == [
+        [observable] for observable in observables
+    ]
+
+
+def test_enrich_call_pushes_rrtypes_and_aggregation_down(
+        client, valid_jwt, get_public_key,
+        mock_request, mock_farsight_request
+):
+    mock_request.return_value = get_public_key
+    mock_farsight_request.side_effect = farsight_api_responses_by_value({})
+
+    client.post(
+        '/observe/observables', headers=headers(valid_jwt()),
+        json=[{'type': 'domain', 'value': 'google.com'},
+              {'type': 'ip', 'value': '1.1.1.1'}]
+    )
+
+    requests = {
+        call.args[0]: call.kwargs['params']
+        for call in mock_farsight_request.call_args_list
+    }
+    assert sorted(requests) == [
+        'https://api.dnsdb.info/lookup/rdata/ip/1.1.1.1',
+        'https://api.dnsdb.info/lookup/rrset/name/google.com/A',
+        'https://api.dnsdb.info/lookup/rrset/name/google.com/AAAA',
+    ]
+    assert all(params['aggr'] for params in requests.values())
+
+
+def test_enrich_call_with_changed_data_structure(
+        client, valid_jwt, valid_json, key_error_body, get_public_key,
+        mock_request, mock_farsight_request, stream_response
+):
+    mock_request.return_value = get_public_key
+    mock_farsight_request.return_value = farsight_api_response_mock(
+        HTTPStatus.OK, payload=[{'rrname': 'google.com.'}]
+    )
+
+    response = client.post(
+        '/observe/observables', headers=headers(valid_jwt()),
+        json=valid_json
+    )
+
+    assert response.status_code == HTTPStatus.OK
+    assert response.get_json() == key_error_body
+
+
+def test_enrich_call_closes_stream_on_unexpected_error(
+        client, valid_jwt, valid_json, farsight_response_ok, get_public_key,
+        mock_request, mock_farsight_request
 ):
-    with patch('requests.get') as get_mock:
-        get_mock.side_effect = [
-            get_public_key,
-            farsight_response_ok,
-            farsight_response_not_found,
-            farsight_response_unauthorized_creds]
+    mock_request.return_value = get_public_key
+    mock_farsight_request.return_value = farsight_response_ok
+
+    with patch.dict(client.application.config,
+                    STREAM_OBSERVE_RESPONSE=True), \
+            patch('api.mappings.Mapping.extract_sightings',
+                  side_effect=ValueError):
         response = client.post(
             '/observe/observables', headers=headers(valid_jwt()),
-            json=valid_json_multiple
+            json=valid_json
         )
 
-        assert response.status_code == HTTPStatus.OK
+    assert response.status_code == HTTPStatus.OK
+    assert response.get_json() == {
+        'errors': [{'type': 'fatal', 'code': 'unknown',
+                    'message': 'Something went wrong.'}]
+    }
 
-        response = response.get_json()
 
-        assert response['data']['sightings']['docs'][0].pop('id')
-        assert response['data']['sightings']['docs'][0].pop('observed_time')
+def test_enrich_call_looks_duplicates_up_once(
+        client, valid_jwt, farsight_response_ok, get_public_key,
+        mock_request, mock_farsight_request, stream_response
+):
+    observables = [{'type': 'domain', 'value': 'google.com'},
+                   {'type': 'domain', 'value': 'Google.COM.'},
+                   {'type': 'domain', 'value': 'google.com'}]
+    mock_request.return_value = get_public_key
+    mock_farsight_request.side_effect = farsight_api_responses_by_value({
+        'google.com/A': farsight_response_ok
+    })
+
+    response = client.post(
+        '/observe/observables', headers=headers(valid_jwt()),
+        json=observables
+    )
+
+    assert mock_farsight_request.call_count == 2
+    docs = response.get_json()['data']['sightings']['docs']
+    assert [doc['observables'] for doc in docs] == [
+        [observable] for observable in observables
+    ]
+    assert docs[1]['relations'][0]['source'] == observables[1]
+
+
+def test_enrich_call_closes_unconsumed_streams_at_deadline(
+        client, valid_jwt, get_public_key, mock_request,
+        mock_farsight_request, stream_response
+):
+    responses = {}
+
+    def side_effect(url, *args, **kwargs):
+        if url.endswith('/AAAA'):
+            sleep(0.5)
+        response = responses[url] = farsight_api_response_mock(
+            HTTPStatus.OK, payload=[]
+        )
+        return response
+
+    mock_request.return_value = get_public_key
+    mock_farsight_request.side_effect = side_effect
+
+    with patch.dict(client.application.config, FARSIGHT_CACHE_TTL=0):
+        response = client.post(
+            '/observe/observables',
+            headers=headers(valid_jwt(request_deadline=0.2)),
+            json=[{'type': 'domain', 'value': 'slow.com'}]
+        )
+
+    assert response.get_json()['errors'][0]['code'] == 'timeout'
+    sleep(0.5)
+    assert len(responses) == 2
+    for response in responses.values():
+        response.close.assert_called()
+
+
+def test_enrich_call_returns_partial_result_at_deadline(
+        client, valid_jwt, farsight_response_ok, get_public_key,
+        mock_request, mock_farsight_request, stream_response
+):
+    def side_effect(url, *args, **kwargs):
+        if '/slow.com/' in url:
+            sleep(1)
+        return farsight_response_ok
+
+    mock_request.return_value = get_public_key
+    mock_farsight_request.side_effect = side_effect
+
+    response = client.post(
+        '/observe/observables',
+        headers=headers(valid_jwt(request_deadline=0.2)),
+        json=[{'type': 'domain', 'value': 'google.com'},
+              {'type': 'domain', 'value': 'slow.com'},
+              {'type': 'domain', 'value': 'SLOW.com.'}]
+    )
 
-        assert response['data'] == success_enrich_body['data']
-        assert response['errors'] == unauthorized_creds_body['errors']
+    response = response.get_json()
+    assert response['data']['sightings']['count'] == 1
+    assert response['errors'] == [{
+        'type': 'warning',
+        'code': 'timeout',
+        'message': f'The lookup of {value} in Farsight DNSDB '
+                   'did not finish in time, its sightings are missing.'
+    } for value in ('slow.com', 'SLOW.com.')]
+    assert all(0 < call.kwargs['timeout'] <= 0.2
+               for call in mock_farsight_request.call_args_list)
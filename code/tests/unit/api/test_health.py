@@ -2,7 +2,7 @@ from http import HTTPStatus
 from pytest import fixture
 from .utils import headers
 from requests.exceptions import SSLError
-from unittest.mock import patch, MagicMock
+from unittest.mock import MagicMock, patch
 
 
 def routes():
@@ -17,33 +17,84 @@ def route(request):
 def test_health_call_with_ssl_error_failure(
         route, client, valid_jwt,
         sslerror_expected_payload,
-        get_public_key,
+        mock_request, mock_farsight_request, get_public_key,
 ):
-    with patch('requests.get') as get_mock:
-        mock_exception = MagicMock()
-        mock_exception.reason.args.__getitem__().verify_message \
-            = 'self signed certificate'
-        get_mock.side_effect = (
-            get_public_key,
-            SSLError(mock_exception)
-        )
+    mock_exception = MagicMock()
+    mock_exception.reason.args.__getitem__().verify_message \
+        = 'self signed certificate'
+    mock_request.return_value = get_public_key
+    mock_farsight_request.side_effect = SSLError(mock_exception)
 
-        response = client.post(
-            route, headers=headers(valid_jwt())
-        )
+    response = client.post(
+        route, headers=headers(valid_jwt())
+    )
 
-        assert response.status_code == HTTPStatus.OK
-        assert response.json == sslerror_expected_payload
+    assert response.status_code == HTTPStatus.OK
+    assert response.json == sslerror_expected_payload
 
 
-def test_health_call_success(route, client, valid_jwt, farsight_response_ok,
+def test_health_call_success(route, client, valid_jwt,
+                             farsight_response_rate_limit,
+                             mock_request, mock_farsight_request,
                              get_public_key):
-    with patch('requests.get') as get_mock:
-        get_mock.side_effect = [
-            get_public_key,
-            farsight_response_ok
-        ]
+    mock_request.return_value = get_public_key
+    mock_farsight_request.return_value = farsight_response_rate_limit
+
+    response = client.post(route, headers=headers(valid_jwt()))
+
+    assert response.status_code == HTTPStatus.OK
+    data = response.json['data']
+    assert data['status'] == 'ok'
+    assert data['quota'] == {
+        'reset': 1433980800, 'limit': 1000, 'remaining': 999
+    }
+    assert isinstance(data['latency_ms'], int)
+    assert data['circuit_breaker']['state'] == 'closed'
+    assert mock_farsight_request.call_args.args[0] == (
+        'https://api.dnsdb.info/lookup/rate_limit'
+    )
+
+
+def test_health_call_is_cached_per_api_key(
+        route, client, valid_jwt, farsight_response_rate_limit,
+        mock_request, mock_farsight_request, get_public_key
+):
+    mock_request.return_value = get_public_key
+    mock_farsight_request.return_value = farsight_response_rate_limit
+
+    first = client.post(route, headers=headers(valid_jwt()))
+    second = client.post(route, headers=headers(valid_jwt()))
+    client.post(route, headers=headers(valid_jwt(key='other_key')))
+
+    assert first.json == second.json
+    assert mock_farsight_request.call_count == 2
+
+
+def test_health_call_with_lookup_check(
+        route, client, valid_jwt, farsight_response_ok,
+        mock_request, mock_farsight_request, get_public_key
+):
+    mock_request.return_value = get_public_key
+    mock_farsight_request.return_value = farsight_response_ok
+    with patch.dict(client.application.config, HEALTH_CHECK='lookup'):
         response = client.post(route, headers=headers(valid_jwt()))
 
-        assert response.status_code == HTTPStatus.OK
-        assert response.json == {'data': {'status': 'ok'}}
+    assert response.json == {'data': {'status': 'ok'}}
+    assert '/lookup/rrset/name/' in mock_farsight_request.call_args.args[0]
+
+
+def test_health_call_with_unauthorized_creds_failure(
+        route, client, valid_jwt, unauthorized_creds_body,
+        farsight_response_unauthorized_creds,
+        mock_request, mock_farsight_request, get_public_key
+):
+    mock_request.return_value = get_public_key
+    farsight_response_unauthorized_creds.__enter__.return_value = (
+        farsight_response_unauthorized_creds
+    )
+    mock_farsight_request.return_value = farsight_response_unauthorized_creds
+
+    response = client.post(route, headers=headers(valid_jwt()))
+
+    assert response.status_code == HTTPStatus.OK
+    assert response.json == unauthorized_creds_body
@@ -6,10 +6,14 @@ from pytest import fixture
 
 from api.mappings import (
     Domain, Mapping,
-    IP, IPV6
+    IP, IPV6, Record, Records, timestamp
 )
 
 
+def records(data):
+    return [Record.from_json(r) for r in data]
+
+
 def input_sets():
     TestData = namedtuple('TestData', 'file mapping')
     yield TestData('domain.json',
@@ -40,7 +44,7 @@ def test_map(input_data, aggregate):
         data = json.load(file)
 
         results = getattr(input_data.mapping, 'extract_sightings')(
-            data['input'], 'source_uri', 100, aggregate=aggregate
+            records(data['input']), 'source_uri', 100, aggregate=aggregate
         )
 
         time = datetime.now().isoformat(timespec="minutes")
@@ -59,7 +63,7 @@ def test_limit(input_data):
 
         for limit in (0, 1, 2, 25, 100):
             results = getattr(input_data.mapping, 'extract_sightings')(
-                data['input'], 'source_uri', limit, aggregate=False
+                records(data['input']), 'source_uri', limit, aggregate=False
             )
 
             assert len(results) <= limit
@@ -70,3 +74,124 @@ def test_mapping_for_():
     assert isinstance(Mapping.for_({'type': 'ip'}), IP)
     assert isinstance(Mapping.for_({'type': 'ipv6'}), IPV6)
     assert Mapping.for_({'type': 'whatever'}) is None
+
+
+def test_limit_keeps_most_recent_records_in_order():
+    data = [
+        {'count': i, 'rrname': f'{i}.com.', 'rrtype': 'A',
+         'rdata': '127.0.0.1',
+         'time_first': '2013-01-01T00:00:00Z',
+         'time_last': f'2013-01-{1 + i % 7:02}T00:00:00Z'}
+        for i in range(50)
+    ]
+    expected = sorted(
+        data, key=lambda r: r['time_last'], reverse=True
+    )[:10]
+
+    results = IP({'type': 'ip', 'value': '127.0.0.1'}).extract_sightings(
+        iter(records(data)), 'source_uri', 10, aggregate=False
+    )
+
+    assert [r['count'] for r in results] == [r['count'] for r in expected]
+
+
+def test_record_from_json():
+    record = Record.from_json({
+        'count': 4, 'time_first': 1358487488, 'time_last': 1358896630,
+        'rrname': 'google.com.', 'rrtype': 'A', 'bailiwick': '.',
+        'rdata': ['74.125.128.100', '74.125.128.101']
+    })
+
+    assert record == Record.from_json({
+        'count': 4,
+        'time_first': '2013-01-18T05:38:08Z',
+        'time_last': '2013-01-22T23:17:10Z',
+        'rrname': 'google.com.', 'rrtype': 'A', 'bailiwick': '.',
+        'rdata': ['74.125.128.100', '74.125.128.101']
+    })
+    assert record.rdata == ('74.125.128.100', '74.125.128.101')
+    assert record.last_seen == 1358896630
+
+
+def test_timestamp():
+    assert timestamp('1970-01-01T00:00:00Z') == 0
+    assert timestamp('2013-01-18T05:38:08Z') == 1358487488
+
+
+def test_sightings_have_unique_ids_and_shared_time():
+    with open('tests/unit/data/domain.json') as file:
+        data = json.load(file)
+
+    mapping = Domain({'type': 'domain', 'value': 'google.com'})
+    results = mapping.extract_sightings(
+        records(data['input']), 'source_uri', 100, aggregate=False
+    ) + mapping.extract_sightings(
+        records(data['input']), 'source_uri', 100,
+        now='2021-01-01T00:00:00Z'
+    )
+
+    ids = [r['id'] for r in results]
+    assert len(set(ids)) == len(ids)
+    assert results[-1]['observed_time'] == {
+        'start_time': '2021-01-01T00:00:00Z',
+        'end_time': '2021-01-01T00:00:00Z'
+    }
+
+
+def test_aggregate_keeps_most_recently_seen_relations():
+    data = [
+        {'count': 1, 'rrname': f'{i % 10}.com.', 'rrtype': 'A',
+         'rdata': '127.0.0.1',
+         'zone_time_first': '2013-01-01T00:00:00Z',
+         'zone_time_last': f'2013-01-{1 + i:02}T00:00:00Z'}
+        for i in range(20)
+    ]
+
+    results = IP({'type': 'ip', 'value': '127.0.0.1'}).extract_sightings(
+        records(data), 'source_uri', 3
+    )
+
+    assert len(results) == 1
+    assert results[0]['count'] == 20
+    assert [r['source']['value'] for r in results[0]['relations']] == [
+        '7.com', '8.com', '9.com'
+    ]
+    assert results[0]['description'] == (
+        'Hostnames that have resolved to 127.0.0.1'
+        ' (3 most recently seen of 10)'
+    )
+
+
+def test_limited_records_are_described():
+    mapping = IP({'type': 'ip', 'value': '127.0.0.1'})
+    data = [{'count': 1, 'rrname': f'{i}.com.', 'rrtype': 'A',
+             'rdata': '127.0.0.1', 'time_first': 1, 'time_last': i}
+            for i in range(3)]
+
+    def description(limit, aggregate):
+        return mapping.extract_sightings(
+            Records(records(data), limited=True), 'source_uri', limit,
+            aggregate
+        )[0]['description']
+
+    assert description(2, True) == (
+        'Hostnames that have resolved to 127.0.0.1'
+        ' (2 most recently seen of at least 3)'
+    )
+    assert description(3, True) == (
+        'Hostnames that have resolved to 127.0.0.1'
+        ' (results truncated)'
+    )
+    assert description(3, False) == (
+        'Hostname that has resolved to 127.0.0.1'
+        ' (results truncated)'
+    )
+
+
+def test_normalize():
+    assert Domain.normalize('WWW.Google.com.') == 'www.google.com'
+    assert IP.normalize('127.0.0.1') == '127.0.0.1'
+    assert IPV6.normalize(
+        '2001:0db8:85a3:0000:0000:8a2e:0370:7334'
+    ) == '2001:db8:85a3::8a2e:370:7334'
+    assert IPV6.normalize('not an ip') == 'not an ip'
@@ -0,0 +1,59 @@
+from time import time
+
+from pytest import fixture
+
+from api.ratelimit import (
+    RateLimiter, SQLiteTokenBuckets, TokenBuckets, _take
+)
+
+
+@fixture(params=['memory', 'sqlite'])
+def buckets(request, tmp_path):
+    if request.param == 'sqlite':
+        return SQLiteTokenBuckets(str(tmp_path / 'buckets.sqlite3'))
+    return TokenBuckets()
+
+
+def test_take_refills_up_to_capacity():
+    assert _take(0, 0, 100, capacity=2, rate=1) == (1, 0)
+    assert _take(0.5, 0, 0, capacity=2, rate=2) == (0.5, 0.25)
+    assert _take(0, 0, 0, capacity=0, rate=0) == (0, None)
+
+
+def test_rate_limiter_allows_bursts_up_to_capacity(buckets):
+    limiter = RateLimiter(buckets, capacity=3, rate=0.001)
+
+    assert [limiter.acquire('key', time()) for _ in range(4)] == [
+        True, True, True, False
+    ]
+    assert limiter.acquire('other_key', time())
+
+
+def test_rate_limiter_waits_for_tokens_within_budget(buckets):
+    limiter = RateLimiter(buckets, capacity=1, rate=100)
+    limiter.acquire('key', time())
+
+    start = time()
+    assert limiter.acquire('key', start + 1)
+    assert 0 < time() - start < 1
+
+
+def test_rate_limiter_refuses_exhausted_quota(buckets):
+    limiter = RateLimiter(buckets, capacity=10, rate=10)
+
+    assert not limiter.acquire('key', time() + 1, capacity=0, rate=0)
+
+
+def test_rate_limiter_shares_sqlite_buckets(tmp_path):
+    path = str(tmp_path / 'buckets.sqlite3')
+    first = RateLimiter(SQLiteTokenBuckets(path), capacity=1, rate=0.001)
+    second = RateLimiter(SQLiteTokenBuckets(path), capacity=1, rate=0.001)
+
+    assert first.acquire('key', time())
+    assert not second.acquire('key', time())
+
+
+def test_rate_limiter_without_capacity_does_not_limit(buckets):
+    limiter = RateLimiter(buckets)
+
+    assert all(limiter.acquire('key', time()) for _ in range(100))
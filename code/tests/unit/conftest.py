@@ -1,9 +1,13 @@
 import jwt
 import json
 
+import api.client
+import api.health
+import api.utils
 from app import app
 from pytest import fixture
 from http import HTTPStatus
+from urllib.parse import urlparse
 from unittest.mock import MagicMock, patch
 from api.errors import INVALID_ARGUMENT, UNKNOWN, AUTH_ERROR
 from tests.unit.mock_for_tests import (
@@ -13,6 +17,20 @@ from tests.unit.mock_for_tests import (
 )
 
 
+@fixture(autouse=True)
+def clear_caches():
+    yield
+    api.utils._jwks_cache.clear()
+    api.utils._tokens_cache.clear()
+    api.health._health_cache.clear()
+    if api.client._lookups_cache is not None:
+        api.client._lookups_cache.clear()
+    if api.client._rate_limiter is not None:
+        api.client._rate_limiter.clear()
+    if api.client._breaker is not None:
+        api.client._breaker.reset()
+
+
 @fixture(scope='session')
 def client():
     app.rsa_private_key = PRIVATE_KEY
@@ -24,7 +42,7 @@ def client():
 
 
 def farsight_api_response_mock(status_code, payload=None):
-    def iter_lines():
+    def iter_lines(**kwargs):
         for r in payload:
             yield r
 
@@ -34,13 +52,31 @@ def farsight_api_response_mock(status_code, payload=None):
     mock_response.ok = status_code == HTTPStatus.OK
 
     payload = payload or []
-    payload = (json.dumps(r) for r in payload)
+    payload = [json.dumps(r) for r in payload]
 
     mock_response.iter_lines = iter_lines
 
     return mock_response
 
 
+def farsight_api_responses_by_value(responses, default=None):
+    """
+    Build a side effect which answers a Farsight lookup with the response
+    registered for the observable value, optionally followed by an rrtype
+    like `google.com/A`, found in the requested URL.
+
+    """
+    def side_effect(url, *args, **kwargs):
+        path = urlparse(url).path + '/'
+        for value, response in responses.items():
+            if f'/{value}/' in path:
+                return response
+
+        return default or farsight_api_error_mock(HTTPStatus.NOT_FOUND)
+
+    return side_effect
+
+
 def farsight_api_error_mock(status_code, text=None):
     mock_response = MagicMock()
 
@@ -80,6 +116,7 @@ def valid_jwt(client):
             ctr_entities_limit=0,
             wrong_structure=False,
             wrong_jwks_host=False,
+            request_deadline=None,
     ):
         payload = {
             'key': key,
@@ -89,6 +126,9 @@ def valid_jwt(client):
             'CTR_ENTITIES_LIMIT': ctr_entities_limit
         }
 
+        if request_deadline is not None:
+            payload['REQUEST_DEADLINE'] = request_deadline
+
         if wrong_jwks_host:
             payload.pop('jwks_host')
 
@@ -111,6 +151,12 @@ def mock_request():
         yield mock_request
 
 
+@fixture(scope='function')
+def mock_farsight_request():
+    with patch('requests.Session.get') as mock_request:
+        yield mock_request
+
+
 @fixture(scope='module')
 def valid_json():
     return [{'type': 'domain', 'value': 'google.com'}]
@@ -138,6 +184,17 @@ def farsight_response_ok():
     )
 
 
+@fixture(scope='function')
+def farsight_response_rate_limit():
+    mock_response = farsight_api_error_mock(HTTPStatus.OK)
+    mock_response.__enter__.return_value = mock_response
+    mock_response.json.return_value = {
+        'rate': {'reset': 1433980800, 'limit': 1000, 'remaining': 999}
+    }
+
+    return mock_response
+
+
 @fixture(scope='session')
 def farsight_response_not_found():
     return farsight_api_error_mock(